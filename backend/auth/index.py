@@ -3,232 +3,828 @@
 Обрабатывает регистрацию новых пользователей, вход и обновление профиля
 '''
 
+import base64
 import json
+import logging
 import os
+import re
+import sys
+import threading
+import time
+import traceback
 import hashlib
+import hmac
 import secrets
-from typing import Dict, Any
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Optional, Set, Tuple
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.errors import InvalidSqlStatementName
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+
+# >>> shared: core
+# Общий код функций, копии проверяет и синхронизирует tools/shared_code.py
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+SLOW_QUERY_LOG_LIMIT = 2000
+INLINE_VALUES = re.compile(r'\bVALUES\b', re.IGNORECASE)
+EXECUTE_PREPARED = re.compile(r'EXECUTE (?P<name>\w+)')
+LOG_REQUESTS = os.environ.get('LOG_REQUESTS', '1') != '0'
+
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_PING_INTERVAL = float(os.environ.get('DB_POOL_PING_INTERVAL', '30'))
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', str(30 * 24 * 3600)))
+REVOCATION_REFRESH_INTERVAL = float(os.environ.get('REVOCATION_REFRESH_INTERVAL', '60'))
+
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', '90'))
+
+PROFILE_FIELDS = ('id', 'username', 'name', 'avatar', 'banner', 'bio', 'last_seen', 'online')
+PROFILE_DEFAULT_FIELDS = ('id', 'username', 'name', 'avatar', 'online')
+PROFILE_CACHE_MAX_SIZE = int(os.environ.get('PROFILE_CACHE_MAX_SIZE', '10000'))
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_request_metrics = threading.local()
+_revoked_jtis: Set[str] = set()
+_revoked_loaded_at = float('-inf')
+_profile_cache_lock = threading.Lock()
+_profile_cache: 'OrderedDict[int, Dict[str, Any]]' = OrderedDict()
+
+
+def b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def get_session_secret() -> bytes:
+    secret = os.environ.get('SESSION_SECRET')
+    if not secret:
+        raise RuntimeError('SESSION_SECRET не задан')
+    return secret.encode()
+
+
+def sign(payload: str) -> str:
+    return b64encode(hmac.new(get_session_secret(), payload.encode(), hashlib.sha256).digest())
+
+
+def verify_token(token: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not token or token.count('.') != 1:
+        return None
+    payload, signature = token.split('.')
+    if not hmac.compare_digest(signature.encode(), sign(payload).encode()):
+        return None
+    try:
+        claims = json.loads(b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or claims.get('exp', 0) < time.time():
+        return None
+    return claims
+
+
+def is_token_revoked(cur, jti: str) -> bool:
+    global _revoked_jtis, _revoked_loaded_at
+    if time.monotonic() - _revoked_loaded_at > REVOCATION_REFRESH_INTERVAL:
+        cur.execute("SELECT jti FROM revoked_tokens WHERE expires_at > NOW()")
+        _revoked_jtis = {row['jti'] for row in cur.fetchall()}
+        _revoked_loaded_at = time.monotonic()
+    return jti in _revoked_jtis
+
+
+def get_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+class RequestMetrics:
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.phases: Dict[str, float] = {'connect': 0.0, 'query': 0.0, 'serialize': 0.0}
+
+    def add(self, phase: str, started: float) -> float:
+        duration = (time.perf_counter() - started) * 1000
+        self.phases[phase] += duration
+        return duration
+
+    def total(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        return ', '.join([
+            f"connect;dur={self.phases['connect']:.2f}",
+            f"db;dur={self.phases['query']:.2f};desc=\"{self.queries} queries\"",
+            f"serialize;dur={self.phases['serialize']:.2f}",
+            f"total;dur={self.total():.2f}",
+        ])
+
+
+def current_metrics() -> RequestMetrics:
+    metrics = getattr(_request_metrics, 'value', None)
+    if metrics is None:
+        metrics = _request_metrics.value = RequestMetrics()
+    return metrics
+
+
+def get_logger() -> logging.Logger:
+    logger = logging.getLogger('messenger')
+    if not logger.handlers:
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(stream)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def log_event(event: str, level: int = logging.INFO, **fields: Any) -> None:
+    get_logger().log(level, json.dumps({'event': event, 'function': FUNCTION_NAME, **fields}, default=str, ensure_ascii=False))
+
+
+def describe_params(params: Any) -> Dict[str, Any]:
+    # В журнал попадают только число и типы параметров: значения могут содержать текст сообщений и токены
+    if params is None:
+        return {'count': 0, 'types': []}
+    values = list(params.values()) if isinstance(params, dict) else list(params)
+    return {'count': len(values), 'types': [type(value).__name__ for value in values]}
+
+
+class InstrumentedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        metrics = current_metrics()
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.queries += 1
+            duration = metrics.add('query', started)
+            if duration >= SLOW_QUERY_MS:
+                sql = query.decode(errors='replace') if isinstance(query, bytes) else str(query)
+                if isinstance(query, bytes):
+                    # execute_values присылает уже подставленные значения, их в журнал не пишем
+                    inline = INLINE_VALUES.search(sql)
+                    sql = sql[:inline.start()] + 'VALUES ...' if inline else '(запрос с подставленными значениями)'
+                prepared = EXECUTE_PREPARED.match(sql)
+                if prepared and prepared.group('name') in PREPARED_STATEMENTS:
+                    # Вместо «EXECUTE имя (...)» в журнал идёт текст подготовленного запроса, сжатый в одну строку
+                    statement = ' '.join(PREPARED_STATEMENTS[prepared.group('name')][1].split())
+                    sql = f"/* {prepared.group('name')} */ {statement}"
+                log_event('slow_query', logging.WARNING, duration_ms=round(duration, 2),
+                          sql=sql[:SLOW_QUERY_LOG_LIMIT], params=describe_params(vars))
+
+
+def to_json(payload: Any, **kwargs: Any) -> str:
+    started = time.perf_counter()
+    try:
+        return json.dumps(payload, **kwargs)
+    finally:
+        current_metrics().add('serialize', started)
+
+
+def request_action(event: Dict[str, Any]) -> str:
+    params = event.get('queryStringParameters') or {}
+    if params.get('action'):
+        return params['action']
+    if event.get('httpMethod') in ('POST', 'PUT'):
+        try:
+            return (json.loads(event.get('body') or '{}') or {}).get('action') or ''
+        except (ValueError, AttributeError):
+            return ''
+    return next((action for param, action in GET_DEFAULT_ACTIONS if params.get(param)), '')
+
+
+def respond(status: int, payload: Any = None, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    response_headers = dict(CORS_HEADERS)
+    if payload is not None:
+        response_headers['Content-Type'] = 'application/json'
+    response_headers.update(headers or {})
+    return {
+        'statusCode': status,
+        'headers': response_headers,
+        'body': to_json(payload, default=str) if payload is not None else '',
+        'isBase64Encoded': False
+    }
+
+
+def error_response(status: int, message: str) -> Dict[str, Any]:
+    return respond(status, {'error': message})
+
+
+class Request:
+    def __init__(self, event: Dict[str, Any], conn, user_id: Optional[int]) -> None:
+        self.event = event
+        self.method = event.get('httpMethod', 'GET')
+        self.params = event.get('queryStringParameters') or {}
+        self.body = json.loads(event.get('body') or '{}') if self.method in ('POST', 'PUT') else {}
+        self.conn = conn
+        self.cur = conn.cursor() if conn is not None else None
+        self.user_id = user_id
+        self.claims: Optional[Dict[str, Any]] = None
+
+
+ROUTES: Dict[Tuple[str, str], Tuple[Callable[[Request], Dict[str, Any]], bool]] = {}
+
+
+def route(method: str, action: str, auth: bool = False) -> Callable:
+    def register(func: Callable[[Request], Dict[str, Any]]) -> Callable[[Request], Dict[str, Any]]:
+        ROUTES[(method, action)] = (func, auth)
+        return func
+    return register
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        # Имена подготовленных запросов и время последнего использования живут вместе с соединением
+        self.prepared: Set[str] = set()
+        self.last_used = time.monotonic()
+
+
+class KeepIdleConnectionPool(ThreadedConnectionPool):
+    def __init__(self, minconn: int, maxconn: int, *args: Any, **kwargs: Any) -> None:
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # psycopg2 закрывает возвращённое соединение, если свободных уже minconn;
+        # после открытия стартовых соединений порог поднимается, и свободные держатся до maxconn
+        self.minconn = maxconn
+
+
+def prepare_statement(cur, name: str) -> None:
+    types, sql = PREPARED_STATEMENTS[name]
+    cur.execute(f"PREPARE {name} ({', '.join(types)}) AS {sql}")
+    cur.connection.prepared.add(name)
+
+
+def execute_prepared(cur, name: str, params: Tuple = ()) -> None:
+    # PREPARE выполняется один раз на соединение пула, дальше Postgres переиспользует разобранный запрос
+    conn = cur.connection
+    if name not in conn.prepared:
+        prepare_statement(cur, name)
+    fresh_transaction = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    execute = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})"
+    try:
+        cur.execute(execute, params)
+    except InvalidSqlStatementName:
+        # Запрос пропал на сервере (DISCARD, DEALLOCATE): без начатой работы транзакцию можно откатить и подготовить заново
+        conn.prepared.clear()
+        if not fresh_transaction:
+            raise
+        conn.rollback()
+        prepare_statement(cur, name)
+        cur.execute(execute, params)
+
+
+def get_db_pool() -> KeepIdleConnectionPool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = KeepIdleConnectionPool(
+                    DB_POOL_MIN_SIZE,
+                    DB_POOL_MAX_SIZE,
+                    os.environ.get('DATABASE_URL'),
+                    connection_factory=PooledConnection,
+                    cursor_factory=InstrumentedCursor
+                )
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < DB_POOL_PING_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def get_db_connection():
+    started = time.perf_counter()
+    pool = get_db_pool()
+    for _ in range(DB_POOL_MAX_SIZE + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            current_metrics().add('connect', started)
+            return conn
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError('Не удалось получить рабочее соединение с базой данных')
+
+
+def release_db_connection(conn) -> None:
+    pool = get_db_pool()
+    try:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        return
+    conn.last_used = time.monotonic()
+    pool.putconn(conn)
+
+
+def presence_online_sql(column: str = 'last_seen') -> str:
+    return f"({column} > CURRENT_TIMESTAMP - INTERVAL '{PRESENCE_TTL} seconds')"
+
+
+def parse_profile_fields(value: Optional[str]) -> Tuple[str, ...]:
+    if not value:
+        return PROFILE_DEFAULT_FIELDS
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in PROFILE_FIELDS]
+    if unknown:
+        raise ValueError(', '.join(unknown))
+    return ('id',) + tuple(dict.fromkeys(field for field in fields if field != 'id'))
+
+
+def load_profiles(cur, versions: List[Dict[str, Any]], fields: Tuple[str, ...],
+                  extra: Tuple[str, ...] = ()) -> List[Dict[str, Any]]:
+    # Кэш хранит статичную часть профиля и сверяется с profile_version, присутствие берётся из versions
+    profiles: Dict[int, Dict[str, Any]] = {}
+    missing = []
+    with _profile_cache_lock:
+        for row in versions:
+            cached = _profile_cache.get(row['id'])
+            if cached is not None and cached['profile_version'] == row['profile_version']:
+                _profile_cache.move_to_end(row['id'])
+                profiles[row['id']] = cached
+            else:
+                missing.append(row['id'])
+    
+    if missing:
+        execute_prepared(cur, 'profiles', (missing,))
+        loaded = [dict(row) for row in cur.fetchall()]
+        with _profile_cache_lock:
+            for profile in loaded:
+                _profile_cache[profile['id']] = profile
+                _profile_cache.move_to_end(profile['id'])
+            while len(_profile_cache) > PROFILE_CACHE_MAX_SIZE:
+                _profile_cache.popitem(last=False)
+        profiles.update((profile['id'], profile) for profile in loaded)
+    
+    result = []
+    for row in versions:
+        profile = profiles.get(row['id'])
+        if profile is None:
+            continue
+        merged = dict(profile, **row)
+        result.append({field: merged[field] for field in fields + extra})
+    return result
+# <<< shared: core
+
+
+FUNCTION_NAME = 'auth'
+
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+ALLOWED_METHODS = 'GET, POST, PUT, OPTIONS'
+ALLOWED_HEADERS = 'Content-Type, X-User-Token'
+# GET без action маршрутизируется по первому найденному параметру
+GET_DEFAULT_ACTIONS = (('search', 'search'),)
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', '30'))
+SEARCH_CACHE_MAX_SIZE = int(os.environ.get('SEARCH_CACHE_MAX_SIZE', '512'))
+
+PRESENCE_HEARTBEAT_INTERVAL = PRESENCE_TTL // 3
+PRESENCE_WRITE_INTERVAL = float(os.environ.get('PRESENCE_WRITE_INTERVAL', '30'))
+PRESENCE_MAX_IDS = 200
+
+PROFILE_MAX_IDS = 500
+
+_search_cache_lock = threading.Lock()
+_search_cache: 'OrderedDict[Tuple[str, str, int], Tuple[float, Dict[str, Any]]]' = OrderedDict()
+_presence_lock = threading.Lock()
+_presence_pending: Dict[int, float] = {}
+_presence_written: Dict[int, float] = {}
 
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
 
 
-def generate_token() -> str:
-    return secrets.token_urlsafe(32)
+def generate_token(user_id: int) -> str:
+    claims = {'uid': user_id, 'exp': int(time.time()) + SESSION_TTL, 'jti': secrets.token_urlsafe(12)}
+    payload = b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    return f'{payload}.{sign(payload)}'
 
 
-def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def encode_search_cursor(rank: int, sort_key: str, user_id: int) -> str:
+    return b64encode(json.dumps([rank, sort_key, user_id]).encode())
+
+
+def decode_search_cursor(cursor: Optional[str]) -> Optional[Tuple[int, str, int]]:
+    if not cursor:
+        return None
+    rank, sort_key, user_id = json.loads(b64decode(cursor))
+    return int(rank), str(sort_key), int(user_id)
+
+
+def search_users(cur, search: str, cursor: Optional[Tuple[int, str, int]], limit: int) -> Dict[str, Any]:
+    escaped = escape_like(search)
+    if cursor is None:
+        execute_prepared(cur, 'search_users', (search, f'{escaped}%', f'%{escaped}%', limit + 1))
+    else:
+        execute_prepared(cur, 'search_users_after', (search, f'{escaped}%', f'%{escaped}%', limit + 1) + cursor)
+    rows = [dict(row) for row in cur.fetchall()]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = encode_search_cursor(last['rank'], last['sort_key'], last['id'])
+    
+    users = []
+    for row in rows:
+        row.pop('rank')
+        row.pop('sort_key')
+        users.append(row)
+    
+    return {'users': users, 'next_cursor': next_cursor}
+
+
+def search_cache_get(key: Tuple[str, str, int]) -> Optional[Dict[str, Any]]:
+    with _search_cache_lock:
+        entry = _search_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del _search_cache[key]
+            return None
+        _search_cache.move_to_end(key)
+        return result
+
+
+def search_cache_put(key: Tuple[str, str, int], result: Dict[str, Any]) -> None:
+    with _search_cache_lock:
+        _search_cache[key] = (time.monotonic() + SEARCH_CACHE_TTL, result)
+        _search_cache.move_to_end(key)
+        while len(_search_cache) > SEARCH_CACHE_MAX_SIZE:
+            _search_cache.popitem(last=False)
+
+
+def search_cache_clear() -> None:
+    with _search_cache_lock:
+        _search_cache.clear()
+
+
+def search_users_sql(cursor_filter: str = '') -> str:
+    return f'''SELECT * FROM (
+            SELECT id, username, name, avatar, bio, last_seen, {presence_online_sql()} AS online, lower(username) AS sort_key,
+               CASE
+                   WHEN lower(username) = lower($1) OR lower(name) = lower($1) THEN 0
+                   WHEN username ILIKE $2 OR name ILIKE $2 THEN 1
+                   ELSE 2
+               END AS rank
+            FROM users
+            WHERE username ILIKE $3 OR name ILIKE $3
+        ) found
+        {cursor_filter}
+        ORDER BY rank, sort_key, id
+        LIMIT $4'''
+
+
+PREPARED_STATEMENTS: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    'search_users': (('text', 'text', 'text', 'integer'), search_users_sql()),
+    'search_users_after': (('text', 'text', 'text', 'integer', 'integer', 'text', 'integer'),
+                           search_users_sql('WHERE (rank, sort_key, id) > ($5, $6, $7)')),
+    'presence': (('integer[]', 'float8[]', 'integer[]'), f'''SELECT user_id, last_seen, {presence_online_sql()} AS online FROM (
+            SELECT u.id AS user_id, GREATEST(u.last_seen, to_timestamp(p.seen)::timestamp) AS last_seen
+            FROM users u
+            LEFT JOIN unnest($1, $2) AS p(id, seen) ON p.id = u.id
+            WHERE u.id = ANY($3)
+        ) presence
+        ORDER BY user_id'''),
+    'profile_versions': (('integer[]', 'float8[]', 'integer[]'), f'''SELECT id, profile_version, last_seen, {presence_online_sql()} AS online FROM (
+            SELECT u.id, u.profile_version, GREATEST(u.last_seen, to_timestamp(p.seen)::timestamp) AS last_seen
+            FROM users u
+            LEFT JOIN unnest($1, $2) AS p(id, seen) ON p.id = u.id
+            WHERE u.id = ANY($3)
+        ) versions'''),
+    'profiles': (('integer[]',), "SELECT id, username, name, avatar, banner, bio, profile_version FROM users WHERE id = ANY($1)"),
+    'login_user': (('text', 'text'),
+                   "SELECT id, username, name, avatar, banner, bio, last_seen FROM users WHERE username = $1 AND password_hash = $2"),
+    'user_by_username': (('text',), "SELECT id FROM users WHERE username = $1"),
+    'insert_user': (('text', 'text', 'text', 'text'),
+                    f"INSERT INTO users (username, name, password_hash, avatar) VALUES ($1, $2, $3, $4) RETURNING id, username, name, avatar, bio, last_seen, {presence_online_sql()} AS online"),
+    'list_users': (('integer',), f"SELECT id, username, name, avatar, bio, last_seen, {presence_online_sql()} AS online FROM users LIMIT $1"),
+    'revoke_token': (('text', 'integer', 'bigint'), '''INSERT INTO revoked_tokens (jti, user_id, expires_at)
+        VALUES ($1, $2, to_timestamp($3)::timestamp)
+        ON CONFLICT (jti) DO NOTHING'''),
+}
+
+
+def record_heartbeat(cur, user_id: int) -> None:
+    # Пульсы копятся в памяти и пишутся одним UPDATE не чаще раза в PRESENCE_WRITE_INTERVAL на пользователя
+    now = time.time()
+    with _presence_lock:
+        _presence_pending[user_id] = now
+        if now - _presence_written.get(user_id, 0.0) < PRESENCE_WRITE_INTERVAL:
+            return
+        batch = list(_presence_pending.items())
+        _presence_pending.clear()
+        for written in [uid for uid, at in _presence_written.items() if now - at >= PRESENCE_WRITE_INTERVAL]:
+            del _presence_written[written]
+        for uid, _ in batch:
+            _presence_written[uid] = now
+    
+    execute_values(
+        cur,
+        '''UPDATE users u SET last_seen = v.seen
+        FROM (VALUES %s) AS v(id, seen)
+        WHERE u.id = v.id AND u.last_seen < v.seen''',
+        batch,
+        template='(%s::integer, to_timestamp(%s)::timestamp)',
+        page_size=len(batch)
+    )
+
+
+def forget_presence(user_id: int) -> None:
+    with _presence_lock:
+        _presence_pending.pop(user_id, None)
+        _presence_written.pop(user_id, None)
+
+
+def fetch_presence(cur, user_ids: List[int]) -> List[Dict[str, Any]]:
+    with _presence_lock:
+        pending = [(uid, _presence_pending[uid]) for uid in user_ids if uid in _presence_pending]
+    execute_prepared(cur, 'presence', ([uid for uid, _ in pending], [seen for _, seen in pending], user_ids))
+    return [dict(row) for row in cur.fetchall()]
+
+
+def fetch_profiles(cur, user_ids: List[int], fields: Tuple[str, ...]) -> List[Dict[str, Any]]:
+    with _presence_lock:
+        pending = [(uid, _presence_pending[uid]) for uid in user_ids if uid in _presence_pending]
+    execute_prepared(cur, 'profile_versions', ([uid for uid, _ in pending], [seen for _, seen in pending], user_ids))
+    versions = {row['id']: dict(row) for row in cur.fetchall()}
+    return load_profiles(cur, [versions[uid] for uid in user_ids if uid in versions], fields)
+
+
+def profile_cache_forget(user_id: int) -> None:
+    with _profile_cache_lock:
+        _profile_cache.pop(user_id, None)
+
+
+@route('POST', 'register')
+def register(req: Request) -> Dict[str, Any]:
+    username = req.body.get('username', '').strip()
+    name = req.body.get('name', '').strip()
+    password = req.body.get('password', '')
+    
+    if not username or not name or not password:
+        return error_response(400, 'Все поля обязательны')
+    
+    execute_prepared(req.cur, 'user_by_username', (username,))
+    if req.cur.fetchone():
+        return error_response(400, 'Пользователь с таким username уже существует')
+    
+    password_hash = hash_password(password)
+    avatar = f"https://api.dicebear.com/7.x/avataaars/svg?seed={username}"
+    
+    execute_prepared(req.cur, 'insert_user', (username, name, password_hash, avatar))
+    user = req.cur.fetchone()
+    req.conn.commit()
+    search_cache_clear()
+    
+    return respond(200, {'token': generate_token(user['id']), 'user': dict(user)})
+
+
+@route('POST', 'logout', auth=True)
+def logout(req: Request) -> Dict[str, Any]:
+    claims = req.claims
+    execute_prepared(req.cur, 'revoke_token', (claims['jti'], claims['uid'], claims['exp']))
+    req.conn.commit()
+    _revoked_jtis.add(claims['jti'])
+    forget_presence(claims['uid'])
+    
+    return respond(200, {'success': True})
+
+
+@route('POST', 'heartbeat', auth=True)
+def heartbeat(req: Request) -> Dict[str, Any]:
+    record_heartbeat(req.cur, req.user_id)
+    req.conn.commit()
+    
+    return respond(200, {'online': True, 'ttl': PRESENCE_TTL, 'heartbeat_interval': PRESENCE_HEARTBEAT_INTERVAL})
+
+
+@route('POST', 'login')
+def login(req: Request) -> Dict[str, Any]:
+    username = req.body.get('username', '').strip()
+    password = req.body.get('password', '')
+    
+    if not username or not password:
+        return error_response(400, 'Username и пароль обязательны')
+    
+    execute_prepared(req.cur, 'login_user', (username, hash_password(password)))
+    user = req.cur.fetchone()
+    
+    if not user:
+        return error_response(401, 'Неверный username или пароль')
+    
+    record_heartbeat(req.cur, user['id'])
+    req.conn.commit()
+    
+    return respond(200, {'token': generate_token(user['id']), 'user': dict(user, online=True)})
+
+
+@route('PUT', '', auth=True)
+def update_profile(req: Request) -> Dict[str, Any]:
+    body = req.body
+    user_id = body.get('user_id')
+    
+    if not user_id:
+        return error_response(400, 'user_id обязателен')
+    
+    if str(user_id) != str(req.user_id):
+        return error_response(403, 'Можно изменять только свой профиль')
+    
+    updates = []
+    params = []
+    
+    if 'name' in body and body['name']:
+        updates.append("name = %s")
+        params.append(body['name'])
+    
+    if 'username' in body and body['username']:
+        updates.append("username = %s")
+        params.append(body['username'])
+    
+    if 'bio' in body:
+        updates.append("bio = %s")
+        params.append(body['bio'])
+    
+    if 'avatar' in body:
+        updates.append("avatar = %s")
+        params.append(body['avatar'])
+    
+    if 'banner' in body:
+        updates.append("banner = %s")
+        params.append(body['banner'])
+    
+    if not updates:
+        return error_response(400, 'Нет данных для обновления')
+    
+    updates.append("profile_version = profile_version + 1")
+    params.append(user_id)
+    query = f"UPDATE users SET {', '.join(updates)} WHERE id = %s RETURNING id, username, name, avatar, banner, bio, last_seen, {presence_online_sql()} AS online"
+    
+    req.cur.execute(query, tuple(params))
+    user = req.cur.fetchone()
+    req.conn.commit()
+    search_cache_clear()
+    profile_cache_forget(req.user_id)
+    
+    return respond(200, {'user': dict(user)})
+
+
+@route('GET', 'presence')
+def presence(req: Request) -> Dict[str, Any]:
+    try:
+        user_ids = sorted({int(user_id) for user_id in (req.params.get('ids') or '').split(',') if user_id})
+    except ValueError:
+        user_ids = []
+    if not user_ids or len(user_ids) > PRESENCE_MAX_IDS:
+        return error_response(400, f'ids: от 1 до {PRESENCE_MAX_IDS} чисел через запятую')
+    
+    return respond(200, {'presence': fetch_presence(req.cur, user_ids), 'ttl': PRESENCE_TTL})
+
+
+@route('GET', 'users')
+def users_by_ids(req: Request) -> Dict[str, Any]:
+    try:
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in (req.params.get('ids') or '').split(',') if user_id))
+    except ValueError:
+        user_ids = []
+    if not user_ids or len(user_ids) > PROFILE_MAX_IDS:
+        return error_response(400, f'ids: от 1 до {PROFILE_MAX_IDS} чисел через запятую')
+    
+    try:
+        fields = parse_profile_fields(req.params.get('fields'))
+    except ValueError as e:
+        return error_response(400, f'Неизвестные поля: {e}')
+    
+    return respond(200, {'users': fetch_profiles(req.cur, user_ids, fields)})
+
+
+@route('GET', 'search')
+def search(req: Request) -> Dict[str, Any]:
+    params = req.params
+    search = params.get('search', '').strip()
+    if not search:
+        return list_users(req)
+    
+    try:
+        limit = max(1, min(int(params.get('limit') or SEARCH_PAGE_SIZE), SEARCH_MAX_PAGE_SIZE))
+        cursor = decode_search_cursor(params.get('cursor'))
+    except (TypeError, ValueError):
+        return error_response(400, 'Некорректные limit или cursor')
+    
+    cache_key = (search.lower(), params.get('cursor') or '', limit)
+    result = search_cache_get(cache_key)
+    if result is None:
+        result = search_users(req.cur, search, cursor, limit)
+        search_cache_put(cache_key, result)
+    
+    return respond(200, result)
+
+
+@route('GET', '')
+def list_users(req: Request) -> Dict[str, Any]:
+    execute_prepared(req.cur, 'list_users', (50,))
+    return respond(200, {'users': [dict(row) for row in req.cur.fetchall()]})
+
+
+def authorize(req: Request) -> Optional[Dict[str, Any]]:
+    return None
+
+
+# >>> shared: handler
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return respond(200, headers={
+            'Access-Control-Allow-Methods': ALLOWED_METHODS,
+            'Access-Control-Allow-Headers': ALLOWED_HEADERS,
+            'Access-Control-Max-Age': '86400'
+        })
     
+    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        action_route = ROUTES.get((method, request_action(event)))
+        if action_route is None:
+            return error_response(405, 'Method not allowed')
+        action_handler, requires_auth = action_route
         
-        if method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'register':
-                username = body.get('username', '').strip()
-                name = body.get('name', '').strip()
-                password = body.get('password', '')
-                
-                if not username or not name or not password:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Все поля обязательны'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute("SELECT id FROM users WHERE username = %s", (username,))
-                if cur.fetchone():
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Пользователь с таким username уже существует'}),
-                        'isBase64Encoded': False
-                    }
-                
-                password_hash = hash_password(password)
-                avatar = f"https://api.dicebear.com/7.x/avataaars/svg?seed={username}"
-                
-                cur.execute(
-                    "INSERT INTO users (username, name, password_hash, avatar, online) VALUES (%s, %s, %s, %s, TRUE) RETURNING id, username, name, avatar, bio, online",
-                    (username, name, password_hash, avatar)
-                )
-                user = cur.fetchone()
-                conn.commit()
-                
-                token = generate_token()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'token': token,
-                        'user': dict(user)
-                    }),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'login':
-                username = body.get('username', '').strip()
-                password = body.get('password', '')
-                
-                if not username or not password:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Username и пароль обязательны'}),
-                        'isBase64Encoded': False
-                    }
-                
-                password_hash = hash_password(password)
-                
-                cur.execute(
-                    "SELECT id, username, name, avatar, banner, bio, online FROM users WHERE username = %s AND password_hash = %s",
-                    (username, password_hash)
-                )
-                user = cur.fetchone()
-                
-                if not user:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Неверный username или пароль'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute("UPDATE users SET online = TRUE WHERE id = %s", (user['id'],))
-                conn.commit()
-                
-                token = generate_token()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'token': token,
-                        'user': dict(user)
-                    }),
-                    'isBase64Encoded': False
-                }
+        claims = None
+        if requires_auth:
+            claims = verify_token(get_header(event, 'X-User-Token'))
+            if claims is None:
+                return error_response(401, 'Требуется авторизация')
         
-        elif method == 'PUT':
-            token = event.get('headers', {}).get('X-User-Token') or event.get('headers', {}).get('x-user-token')
-            body = json.loads(event.get('body', '{}'))
-            user_id = body.get('user_id')
-            
-            if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id обязателен'}),
-                    'isBase64Encoded': False
-                }
-            
-            updates = []
-            params = []
-            
-            if 'name' in body and body['name']:
-                updates.append("name = %s")
-                params.append(body['name'])
-            
-            if 'username' in body and body['username']:
-                updates.append("username = %s")
-                params.append(body['username'])
-            
-            if 'bio' in body:
-                updates.append("bio = %s")
-                params.append(body['bio'])
-            
-            if 'avatar' in body:
-                updates.append("avatar = %s")
-                params.append(body['avatar'])
-            
-            if 'banner' in body:
-                updates.append("banner = %s")
-                params.append(body['banner'])
-            
-            if not updates:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Нет данных для обновления'}),
-                    'isBase64Encoded': False
-                }
-            
-            params.append(user_id)
-            query = f"UPDATE users SET {', '.join(updates)} WHERE id = %s RETURNING id, username, name, avatar, banner, bio, online"
-            
-            cur.execute(query, tuple(params))
-            user = cur.fetchone()
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'user': dict(user)}),
-                'isBase64Encoded': False
-            }
+        conn = get_db_connection()
+        req = Request(event, conn, claims['uid'] if claims else None)
+        req.claims = claims
         
-        elif method == 'GET':
-            params = event.get('queryStringParameters', {}) or {}
-            search = params.get('search', '').strip()
-            
-            if search:
-                cur.execute(
-                    "SELECT id, username, name, avatar, bio, online FROM users WHERE username ILIKE %s OR name ILIKE %s LIMIT 20",
-                    (f'%{search}%', f'%{search}%')
-                )
-            else:
-                cur.execute("SELECT id, username, name, avatar, bio, online FROM users LIMIT 50")
-            
-            users = [dict(row) for row in cur.fetchall()]
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'users': users}),
-                'isBase64Encoded': False
-            }
+        if claims is not None and is_token_revoked(req.cur, claims['jti']):
+            return error_response(401, 'Сессия завершена')
         
-        cur.close()
-        conn.close()
+        # Проверки, свои для каждой функции, задаются в её authorize()
+        denied = authorize(req)
+        if denied is not None:
+            return denied
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return action_handler(req)
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        log_event('error', logging.ERROR, error=repr(e), traceback=traceback.format_exc())
+        return error_response(500, str(e))
+    
+    finally:
+        if conn is not None:
+            release_db_connection(conn)
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    _request_metrics.value = metrics = RequestMetrics()
+    response = handle_request(event, context)
+    
+    headers = response.setdefault('headers', {})
+    headers['Server-Timing'] = metrics.server_timing()
+    headers['Access-Control-Expose-Headers'] = 'Server-Timing, ETag'
+    if LOG_REQUESTS:
+        log_event(
+            'request',
+            method=event.get('httpMethod', 'GET'),
+            action=request_action(event),
+            status=response.get('statusCode'),
+            duration_ms=round(metrics.total(), 2),
+            queries=metrics.queries,
+            connect_ms=round(metrics.phases['connect'], 2),
+            query_ms=round(metrics.phases['query'], 2),
+            serialize_ms=round(metrics.phases['serialize'], 2)
+        )
+    _request_metrics.value = None
+    return response
+# <<< shared: handler
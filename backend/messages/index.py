@@ -3,271 +3,1301 @@
 Отправка, получение и управление сообщениями в чатах
 '''
 
+import base64
+import hashlib
+import hmac
+import html
+import itertools
 import json
+import logging
 import os
-from typing import Dict, Any
+import re
+import select
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, Any, List, Optional, Set, Tuple
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.errors import InvalidSqlStatementName
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+
+# >>> shared: core
+# Общий код функций, копии проверяет и синхронизирует tools/shared_code.py
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+SLOW_QUERY_LOG_LIMIT = 2000
+INLINE_VALUES = re.compile(r'\bVALUES\b', re.IGNORECASE)
+EXECUTE_PREPARED = re.compile(r'EXECUTE (?P<name>\w+)')
+LOG_REQUESTS = os.environ.get('LOG_REQUESTS', '1') != '0'
+
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_PING_INTERVAL = float(os.environ.get('DB_POOL_PING_INTERVAL', '30'))
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', str(30 * 24 * 3600)))
+REVOCATION_REFRESH_INTERVAL = float(os.environ.get('REVOCATION_REFRESH_INTERVAL', '60'))
+
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', '90'))
+
+PROFILE_FIELDS = ('id', 'username', 'name', 'avatar', 'banner', 'bio', 'last_seen', 'online')
+PROFILE_DEFAULT_FIELDS = ('id', 'username', 'name', 'avatar', 'online')
+PROFILE_CACHE_MAX_SIZE = int(os.environ.get('PROFILE_CACHE_MAX_SIZE', '10000'))
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_request_metrics = threading.local()
+_revoked_jtis: Set[str] = set()
+_revoked_loaded_at = float('-inf')
+_profile_cache_lock = threading.Lock()
+_profile_cache: 'OrderedDict[int, Dict[str, Any]]' = OrderedDict()
+
+
+def b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def get_session_secret() -> bytes:
+    secret = os.environ.get('SESSION_SECRET')
+    if not secret:
+        raise RuntimeError('SESSION_SECRET не задан')
+    return secret.encode()
+
+
+def sign(payload: str) -> str:
+    return b64encode(hmac.new(get_session_secret(), payload.encode(), hashlib.sha256).digest())
+
+
+def verify_token(token: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not token or token.count('.') != 1:
+        return None
+    payload, signature = token.split('.')
+    if not hmac.compare_digest(signature.encode(), sign(payload).encode()):
+        return None
+    try:
+        claims = json.loads(b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or claims.get('exp', 0) < time.time():
+        return None
+    return claims
+
+
+def is_token_revoked(cur, jti: str) -> bool:
+    global _revoked_jtis, _revoked_loaded_at
+    if time.monotonic() - _revoked_loaded_at > REVOCATION_REFRESH_INTERVAL:
+        cur.execute("SELECT jti FROM revoked_tokens WHERE expires_at > NOW()")
+        _revoked_jtis = {row['jti'] for row in cur.fetchall()}
+        _revoked_loaded_at = time.monotonic()
+    return jti in _revoked_jtis
+
+
+def get_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+class RequestMetrics:
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.phases: Dict[str, float] = {'connect': 0.0, 'query': 0.0, 'serialize': 0.0}
+
+    def add(self, phase: str, started: float) -> float:
+        duration = (time.perf_counter() - started) * 1000
+        self.phases[phase] += duration
+        return duration
+
+    def total(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        return ', '.join([
+            f"connect;dur={self.phases['connect']:.2f}",
+            f"db;dur={self.phases['query']:.2f};desc=\"{self.queries} queries\"",
+            f"serialize;dur={self.phases['serialize']:.2f}",
+            f"total;dur={self.total():.2f}",
+        ])
+
+
+def current_metrics() -> RequestMetrics:
+    metrics = getattr(_request_metrics, 'value', None)
+    if metrics is None:
+        metrics = _request_metrics.value = RequestMetrics()
+    return metrics
+
+
+def get_logger() -> logging.Logger:
+    logger = logging.getLogger('messenger')
+    if not logger.handlers:
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(stream)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def log_event(event: str, level: int = logging.INFO, **fields: Any) -> None:
+    get_logger().log(level, json.dumps({'event': event, 'function': FUNCTION_NAME, **fields}, default=str, ensure_ascii=False))
+
+
+def describe_params(params: Any) -> Dict[str, Any]:
+    # В журнал попадают только число и типы параметров: значения могут содержать текст сообщений и токены
+    if params is None:
+        return {'count': 0, 'types': []}
+    values = list(params.values()) if isinstance(params, dict) else list(params)
+    return {'count': len(values), 'types': [type(value).__name__ for value in values]}
+
+
+class InstrumentedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        metrics = current_metrics()
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.queries += 1
+            duration = metrics.add('query', started)
+            if duration >= SLOW_QUERY_MS:
+                sql = query.decode(errors='replace') if isinstance(query, bytes) else str(query)
+                if isinstance(query, bytes):
+                    # execute_values присылает уже подставленные значения, их в журнал не пишем
+                    inline = INLINE_VALUES.search(sql)
+                    sql = sql[:inline.start()] + 'VALUES ...' if inline else '(запрос с подставленными значениями)'
+                prepared = EXECUTE_PREPARED.match(sql)
+                if prepared and prepared.group('name') in PREPARED_STATEMENTS:
+                    # Вместо «EXECUTE имя (...)» в журнал идёт текст подготовленного запроса, сжатый в одну строку
+                    statement = ' '.join(PREPARED_STATEMENTS[prepared.group('name')][1].split())
+                    sql = f"/* {prepared.group('name')} */ {statement}"
+                log_event('slow_query', logging.WARNING, duration_ms=round(duration, 2),
+                          sql=sql[:SLOW_QUERY_LOG_LIMIT], params=describe_params(vars))
+
+
+def to_json(payload: Any, **kwargs: Any) -> str:
+    started = time.perf_counter()
+    try:
+        return json.dumps(payload, **kwargs)
+    finally:
+        current_metrics().add('serialize', started)
+
+
+def request_action(event: Dict[str, Any]) -> str:
+    params = event.get('queryStringParameters') or {}
+    if params.get('action'):
+        return params['action']
+    if event.get('httpMethod') in ('POST', 'PUT'):
+        try:
+            return (json.loads(event.get('body') or '{}') or {}).get('action') or ''
+        except (ValueError, AttributeError):
+            return ''
+    return next((action for param, action in GET_DEFAULT_ACTIONS if params.get(param)), '')
+
+
+def respond(status: int, payload: Any = None, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    response_headers = dict(CORS_HEADERS)
+    if payload is not None:
+        response_headers['Content-Type'] = 'application/json'
+    response_headers.update(headers or {})
+    return {
+        'statusCode': status,
+        'headers': response_headers,
+        'body': to_json(payload, default=str) if payload is not None else '',
+        'isBase64Encoded': False
+    }
+
+
+def error_response(status: int, message: str) -> Dict[str, Any]:
+    return respond(status, {'error': message})
+
+
+class Request:
+    def __init__(self, event: Dict[str, Any], conn, user_id: Optional[int]) -> None:
+        self.event = event
+        self.method = event.get('httpMethod', 'GET')
+        self.params = event.get('queryStringParameters') or {}
+        self.body = json.loads(event.get('body') or '{}') if self.method in ('POST', 'PUT') else {}
+        self.conn = conn
+        self.cur = conn.cursor() if conn is not None else None
+        self.user_id = user_id
+        self.claims: Optional[Dict[str, Any]] = None
+
+
+ROUTES: Dict[Tuple[str, str], Tuple[Callable[[Request], Dict[str, Any]], bool]] = {}
+
+
+def route(method: str, action: str, auth: bool = False) -> Callable:
+    def register(func: Callable[[Request], Dict[str, Any]]) -> Callable[[Request], Dict[str, Any]]:
+        ROUTES[(method, action)] = (func, auth)
+        return func
+    return register
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        # Имена подготовленных запросов и время последнего использования живут вместе с соединением
+        self.prepared: Set[str] = set()
+        self.last_used = time.monotonic()
+
+
+class KeepIdleConnectionPool(ThreadedConnectionPool):
+    def __init__(self, minconn: int, maxconn: int, *args: Any, **kwargs: Any) -> None:
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # psycopg2 закрывает возвращённое соединение, если свободных уже minconn;
+        # после открытия стартовых соединений порог поднимается, и свободные держатся до maxconn
+        self.minconn = maxconn
+
+
+def prepare_statement(cur, name: str) -> None:
+    types, sql = PREPARED_STATEMENTS[name]
+    cur.execute(f"PREPARE {name} ({', '.join(types)}) AS {sql}")
+    cur.connection.prepared.add(name)
+
+
+def execute_prepared(cur, name: str, params: Tuple = ()) -> None:
+    # PREPARE выполняется один раз на соединение пула, дальше Postgres переиспользует разобранный запрос
+    conn = cur.connection
+    if name not in conn.prepared:
+        prepare_statement(cur, name)
+    fresh_transaction = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+    execute = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})"
+    try:
+        cur.execute(execute, params)
+    except InvalidSqlStatementName:
+        # Запрос пропал на сервере (DISCARD, DEALLOCATE): без начатой работы транзакцию можно откатить и подготовить заново
+        conn.prepared.clear()
+        if not fresh_transaction:
+            raise
+        conn.rollback()
+        prepare_statement(cur, name)
+        cur.execute(execute, params)
+
+
+def get_db_pool() -> KeepIdleConnectionPool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = KeepIdleConnectionPool(
+                    DB_POOL_MIN_SIZE,
+                    DB_POOL_MAX_SIZE,
+                    os.environ.get('DATABASE_URL'),
+                    connection_factory=PooledConnection,
+                    cursor_factory=InstrumentedCursor
+                )
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < DB_POOL_PING_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 
 def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    started = time.perf_counter()
+    pool = get_db_pool()
+    for _ in range(DB_POOL_MAX_SIZE + 1):
+        conn = pool.getconn()
+        if is_connection_healthy(conn):
+            current_metrics().add('connect', started)
+            return conn
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError('Не удалось получить рабочее соединение с базой данных')
 
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method = event.get('httpMethod', 'GET')
+def release_db_connection(conn) -> None:
+    pool = get_db_pool()
+    try:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        return
+    conn.last_used = time.monotonic()
+    pool.putconn(conn)
+
+
+def presence_online_sql(column: str = 'last_seen') -> str:
+    return f"({column} > CURRENT_TIMESTAMP - INTERVAL '{PRESENCE_TTL} seconds')"
+
+
+def parse_profile_fields(value: Optional[str]) -> Tuple[str, ...]:
+    if not value:
+        return PROFILE_DEFAULT_FIELDS
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in PROFILE_FIELDS]
+    if unknown:
+        raise ValueError(', '.join(unknown))
+    return ('id',) + tuple(dict.fromkeys(field for field in fields if field != 'id'))
+
+
+def load_profiles(cur, versions: List[Dict[str, Any]], fields: Tuple[str, ...],
+                  extra: Tuple[str, ...] = ()) -> List[Dict[str, Any]]:
+    # Кэш хранит статичную часть профиля и сверяется с profile_version, присутствие берётся из versions
+    profiles: Dict[int, Dict[str, Any]] = {}
+    missing = []
+    with _profile_cache_lock:
+        for row in versions:
+            cached = _profile_cache.get(row['id'])
+            if cached is not None and cached['profile_version'] == row['profile_version']:
+                _profile_cache.move_to_end(row['id'])
+                profiles[row['id']] = cached
+            else:
+                missing.append(row['id'])
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Token, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    if missing:
+        execute_prepared(cur, 'profiles', (missing,))
+        loaded = [dict(row) for row in cur.fetchall()]
+        with _profile_cache_lock:
+            for profile in loaded:
+                _profile_cache[profile['id']] = profile
+                _profile_cache.move_to_end(profile['id'])
+            while len(_profile_cache) > PROFILE_CACHE_MAX_SIZE:
+                _profile_cache.popitem(last=False)
+        profiles.update((profile['id'], profile) for profile in loaded)
     
+    result = []
+    for row in versions:
+        profile = profiles.get(row['id'])
+        if profile is None:
+            continue
+        merged = dict(profile, **row)
+        result.append({field: merged[field] for field in fields + extra})
+    return result
+# <<< shared: core
+
+
+FUNCTION_NAME = 'messages'
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+UNREAD_COUNT_CAP = 999
+SEND_BATCH_MAX_SIZE = 500
+
+CACHE_CONTROL = 'private, no-cache'
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+ALLOWED_METHODS = 'GET, POST, PUT, OPTIONS'
+ALLOWED_HEADERS = 'Content-Type, X-User-Token, X-User-Id, If-None-Match'
+# GET без action маршрутизируется по первому найденному параметру
+GET_DEFAULT_ACTIONS = (('chat_id', 'history'), ('user_id', 'chats'))
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+SEARCH_CONFIG = 'russian'
+# ts_headline отмечает совпадения управляющими символами, а <mark> подставляется уже после экранирования текста
+SEARCH_HIGHLIGHT_START = '\x01'
+SEARCH_HIGHLIGHT_STOP = '\x02'
+SEARCH_HEADLINE_OPTIONS = (
+    f'StartSel="{SEARCH_HIGHLIGHT_START}", StopSel="{SEARCH_HIGHLIGHT_STOP}", MaxWords=20, MinWords=5, MaxFragments=2'
+)
+
+WAIT_DEFAULT_TIMEOUT = 25
+WAIT_MAX_TIMEOUT = int(os.environ.get('WAIT_MAX_TIMEOUT', '25'))
+# Водяной знак дельт: «снимок pg_snapshot@секунды LOCALTIMESTAMP», снятые до чтения
+WATERMARK_PATTERN = re.compile(r'(?P<snapshot>(?P<xmin>\d+):(?P<xmax>\d+):(?P<xip>\d+(?:,\d+)*)?)@(?P<taken_at>\d+)')
+
+MEMBERS_PAGE_SIZE = 100
+MEMBERS_MAX_PAGE_SIZE = 500
+
+HOT_PARTITION_MONTHS = int(os.environ.get('HOT_PARTITION_MONTHS', '2'))
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_CHECK_INTERVAL = float(os.environ.get('PARTITION_CHECK_INTERVAL', str(6 * 3600)))
+PARTITION_RETRY_INTERVAL = float(os.environ.get('PARTITION_RETRY_INTERVAL', '300'))
+PARTITION_CLOCK_SLACK = 300
+PARTITION_LOCK_TIMEOUT_MS = int(os.environ.get('PARTITION_LOCK_TIMEOUT_MS', '500'))
+
+SUMMARY_REFRESH_INTERVAL = int(os.environ.get('SUMMARY_REFRESH_INTERVAL', '60'))
+
+# Первая проверка — через интервал после старта: короткоживущие экземпляры полагаются на tools/partitions.py ensure
+_partitions_next_check_at = time.monotonic() + PARTITION_CHECK_INTERVAL
+_partitions_lock = threading.Lock()
+
+
+def acts_for_other_user(claimed_ids: List[Any], auth_user_id: int) -> bool:
+    return any(value not in (None, '') and str(value) != str(auth_user_id) for value in claimed_ids)
+
+
+def parse_limit(value: Any, default: int = DEFAULT_PAGE_SIZE, maximum: int = MAX_PAGE_SIZE) -> int:
+    if value in (None, ''):
+        return default
+    return max(1, min(int(value), maximum))
+
+
+def hot_partition_since() -> datetime:
+    month_start = date.today().replace(day=1)
+    months = month_start.year * 12 + month_start.month - HOT_PARTITION_MONTHS
+    return datetime(months // 12, months % 12 + 1, 1)
+
+
+def maintain_message_partitions() -> None:
+    # Вызывается после коммита отправки. DDL секций идёт в фоновом потоке, поэтому ответ его не ждёт
+    if time.monotonic() < _partitions_next_check_at or not _partitions_lock.acquire(blocking=False):
+        return
+    threading.Thread(target=ensure_partitions, name='partitions', daemon=True).start()
+
+
+def ensure_partitions() -> None:
+    # Отдельное соединение с коротким lock_timeout: отправители не ждут блокировку messages дольше него.
+    # После ошибки следующая попытка не раньше PARTITION_RETRY_INTERVAL, чтобы постоянный сбой DDL
+    # (например, строки нового месяца уже в messages_default) не ставил ACCESS EXCLUSIVE в очередь на каждой отправке
+    global _partitions_next_check_at
+    conn = None
+    next_check = PARTITION_RETRY_INTERVAL
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+        cur.execute(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT_MS}ms'")
+        cur.execute("SELECT ensure_message_partitions(%s) AS created", (PARTITION_MONTHS_AHEAD,))
+        created = cur.fetchone()['created']
+        conn.commit()
+        next_check = PARTITION_CHECK_INTERVAL
+        if created:
+            log_event('partitions_created', count=created)
+    except psycopg2.Error as e:
+        log_event('partitions_failed', logging.WARNING, error=repr(e), retry_in=PARTITION_RETRY_INTERVAL)
+    finally:
+        if conn is not None:
+            release_db_connection(conn)
+        _partitions_next_check_at = time.monotonic() + next_check
+        _partitions_lock.release()
+
+
+def chat_history_start(cur, chat_id: Any) -> datetime:
+    execute_prepared(cur, 'chat_created_at', (chat_id,))
+    row = cur.fetchone()
+    if not row or not row['created_at']:
+        return datetime.min
+    return row['created_at'] - timedelta(seconds=PARTITION_CLOCK_SLACK)
+
+
+def fetch_history(cur, chat_id: Any, before_id: Optional[int], after_id: Optional[int],
+                  limit: int, since: Optional[Tuple[str, datetime]] = None) -> List[Dict[str, Any]]:
+    # id и created_at растут вместе с точностью до PARTITION_CLOCK_SLACK, поэтому нижняя граница по времени
+    # отсекает холодные секции, не теряя сообщений. Возвращает до limit + 1 строк: по возрастанию id для after_id,
+    # по убыванию для остальных случаев. С since к after_id добавляются сообщения с меньшим id,
+    # закоммиченные уже после снимка прошлого ответа
+    hot_since = hot_partition_since()
+    slack = timedelta(seconds=PARTITION_CLOCK_SLACK)
+    
+    if after_id is not None:
+        execute_prepared(cur, 'history_anchor', (chat_id, after_id, hot_since))
+        anchor = cur.fetchone()
+        lower = anchor['created_at'] - slack if anchor else chat_history_start(cur, chat_id)
+        if since is None:
+            execute_prepared(cur, 'history_after', (chat_id, after_id, lower, limit + 1))
+        else:
+            snapshot, since_at = since
+            execute_prepared(cur, 'history_after_since', (chat_id, after_id, min(lower, since_at), snapshot, since_at, limit + 1))
+        return [dict(row) for row in cur.fetchall()]
+    
+    def page(lower: datetime) -> List[Dict[str, Any]]:
+        if before_id is None:
+            execute_prepared(cur, 'history_latest', (chat_id, lower, limit + 1))
+        else:
+            execute_prepared(cur, 'history_before', (chat_id, before_id, lower, limit + 1))
+        return [dict(row) for row in cur.fetchall()]
+    
+    rows = page(hot_since)
+    if len(rows) > limit and rows[-1]['created_at'] >= hot_since + slack:
+        return rows
+    history_start = chat_history_start(cur, chat_id)
+    if history_start >= hot_since:
+        return rows
+    return page(history_start)
+
+
+def newest_message_sql(chat: str = 'c') -> str:
+    # Последнее сообщение чата берётся из messages, а chats.last_message_* служит лишь подсказкой нижней границы
+    return f'''SELECT m.id, m.text, m.created_at, COALESCE(m.version, 0) AS version FROM messages m
+        WHERE m.chat_id = {chat}.id
+        AND m.created_at >= COALESCE({chat}.last_message_at, {chat}.created_at, '-infinity')
+            - INTERVAL '{PARTITION_CLOCK_SLACK} seconds'
+        ORDER BY m.id DESC
+        LIMIT 1'''
+
+
+def recent_messages_sql(chat: str = 'c') -> str:
+    # Сообщения рядом с последним (lm) по времени. Сообщение, закоммиченное позже последнего с бо́льшим id,
+    # создано не раньше чем за PARTITION_CLOCK_SLACK до него и меняет это число, хотя последнее сообщение то же
+    return f'''SELECT COUNT(*) AS recent FROM messages m
+        WHERE m.created_at >= lm.created_at - INTERVAL '{PARTITION_CLOCK_SLACK} seconds'
+        AND m.chat_id = {chat}.id'''
+
+
+def other_member_sql() -> str:
+    return '''LEFT JOIN LATERAL (
+               SELECT ocm.user_id FROM chat_members ocm
+               WHERE NOT c.is_group AND ocm.chat_id = cm.chat_id AND ocm.user_id != cm.user_id
+               ORDER BY ocm.user_id
+               LIMIT 1
+           ) ocm ON TRUE
+           LEFT JOIN users ou ON ou.id = ocm.user_id'''
+
+
+def presence_bucket_sql(column: str) -> str:
+    # ETag ответов с флагом online меняется раз в PRESENCE_TTL и когда собеседник появляется в сети,
+    # поэтому 304 держит устаревший статус не дольше одного TTL
+    return f'floor(extract(epoch FROM {column}) / {PRESENCE_TTL})'
+
+
+SEARCH_FILTERS = (
+    ('chat', ('integer',), 'm.chat_id = {}'),
+    ('from', ('timestamp',), 'm.created_at >= {}'),
+    ('to', ('timestamp',), 'm.created_at < {}'),
+    ('cursor', ('numeric', 'integer'), '(round(ts_rank(m.text_tsv, query.q)::numeric, 6), m.id) < ({}, {})'),
+)
+
+
+def search_statement_name(filters: Tuple[str, ...]) -> str:
+    return '_'.join(('search_messages',) + filters)
+
+
+def search_messages_statement(filters: Tuple[str, ...]) -> Tuple[Tuple[str, ...], str]:
+    # Каждому набору фильтров свой подготовленный запрос, параметры нумеруются по порядку SEARCH_FILTERS
+    types = ['regconfig', 'text', 'integer']
+    conditions = []
+    for name, filter_types, condition in SEARCH_FILTERS:
+        if name in filters:
+            conditions.append('AND ' + condition.format(*[f'${len(types) + i + 1}' for i in range(len(filter_types))]))
+            types.extend(filter_types)
+    limit, options = f'${len(types) + 1}', f'${len(types) + 2}'
+    types.extend(['integer', 'text'])
+    conditions_sql = '\n            '.join(conditions)
+    return tuple(types), f'''WITH query AS (
+            SELECT websearch_to_tsquery($1, $2) AS q
+        ),
+        page AS (
+            SELECT m.id, m.chat_id, m.sender_id, m.text, m.created_at,
+               round(ts_rank(m.text_tsv, query.q)::numeric, 6) AS rank
+            FROM messages m
+            CROSS JOIN query
+            WHERE m.text_tsv @@ query.q
+            AND m.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = $3)
+            {conditions_sql}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT {limit}
+        )
+        SELECT p.id, p.chat_id, p.sender_id, p.created_at, p.rank,
+           u.name, u.avatar,
+           ts_headline($1, translate(p.text, chr(1) || chr(2), ''), query.q, {options}) AS snippet
+        FROM page p
+        CROSS JOIN query
+        JOIN users u ON u.id = p.sender_id
+        ORDER BY p.rank DESC, p.id DESC'''
+
+
+def changed_since_sql(snapshot: str, since_at: str) -> str:
+    # Строка изменилась после чтения, если изменившая её транзакция не видна в снимке того чтения.
+    # Сообщения проверяются все, а не только последнее: id выдаётся до коммита, и сообщение с меньшим id
+    # может закоммититься позже последнего. Незакоммиченное к снимку сообщение создано не раньше since_at
+    return f'''AND (NOT pg_visible_in_snapshot(c.changed_xid, {snapshot})
+               OR NOT pg_visible_in_snapshot(cm.changed_xid, {snapshot})
+               OR EXISTS (
+                   SELECT 1 FROM messages m
+                   WHERE m.chat_id = c.id AND m.created_at >= {since_at}
+                   AND NOT pg_visible_in_snapshot(m.changed_xid, {snapshot})
+               ))'''
+
+
+def chat_list_sql(since_filter: str = '') -> str:
+    return f'''SELECT c.id, c.is_group, COALESCE(lm.created_at, c.last_message_at, c.updated_at) as updated_at, c.member_count,
+           CASE WHEN ou.id IS NULL THEN c.name ELSE ou.name END as name,
+           CASE WHEN ou.id IS NULL THEN c.avatar ELSE ou.avatar END as avatar,
+           {presence_online_sql('ou.last_seen')} as online, ou.last_seen, ou.id as other_user_id,
+           GREATEST(c.version, cm.version, lm.version) as version,
+           COALESCE(lm.text, c.last_message_text) as last_message,
+           COALESCE(lm.created_at, c.last_message_at) as last_message_time,
+           COALESCE(cs.pinned, FALSE) as pinned,
+           (SELECT COUNT(*) FROM (
+               SELECT 1 FROM messages m
+               WHERE m.chat_id = cm.chat_id AND m.id > cm.last_read_message_id AND m.sender_id != cm.user_id
+               AND m.created_at >= COALESCE(cm.last_read_at, c.created_at, '-infinity') - INTERVAL '{PARTITION_CLOCK_SLACK} seconds'
+               LIMIT {UNREAD_COUNT_CAP}
+           ) unread) as unread_count
+           FROM chat_members cm
+           JOIN chats c ON c.id = cm.chat_id
+           LEFT JOIN LATERAL ({newest_message_sql()}) lm ON TRUE
+           LEFT JOIN chat_settings cs ON cs.chat_id = cm.chat_id AND cs.user_id = cm.user_id
+           {other_member_sql()}
+           WHERE cm.user_id = $1
+           {since_filter}
+           ORDER BY COALESCE(lm.created_at, c.last_message_at, c.updated_at) DESC'''
+
+
+PREPARED_STATEMENTS: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    # Отдельные запросы с курсором и без него: в общем плане условие «$n IS NULL OR ...» не годится для индекса
+    'chat_list': (('integer',), chat_list_sql()),
+    'chat_list_since': (('integer', 'pg_snapshot', 'timestamp'), chat_list_sql(changed_since_sql('$2', '$3'))),
+    # Сумма, а не максимум версий: версия, закоммиченная позже бо́льшей, всё равно меняет ETag.
+    # Профили и присутствие собеседников попадают в тело ответа, поэтому входят и в ETag
+    'chat_list_etag': (('integer',), f'''SELECT COALESCE(SUM(GREATEST(c.version, cm.version, lm.version)), 0) as version, COUNT(*) as chats,
+           COALESCE(SUM(recent.recent), 0) as recent_messages,
+           COALESCE(SUM(ou.profile_version), 0) as profiles,
+           COALESCE(SUM({presence_bucket_sql('ou.last_seen')}), 0) as presence,
+           {presence_bucket_sql('CURRENT_TIMESTAMP')} as presence_now
+        FROM chat_members cm
+        JOIN chats c ON c.id = cm.chat_id
+        LEFT JOIN LATERAL ({newest_message_sql()}) lm ON TRUE
+        LEFT JOIN LATERAL ({recent_messages_sql()}) recent ON TRUE
+        {other_member_sql()}
+        WHERE cm.user_id = $1'''),
+    'history_etag': (('integer',), f'''SELECT c.version,
+           (SELECT SUM(version) FROM chat_members WHERE chat_id = c.id) as members_version,
+           lm.id as last_message_id,
+           recent.recent as recent_messages,
+           (SELECT SUM(u.profile_version) FROM chat_members hm JOIN users u ON u.id = hm.user_id
+            WHERE hm.chat_id = c.id) as profiles
+        FROM chats c
+        LEFT JOIN LATERAL ({newest_message_sql()}) lm ON TRUE
+        LEFT JOIN LATERAL ({recent_messages_sql()}) recent ON TRUE
+        WHERE c.id = $1'''),
+    'chat_created_at': (('integer',), "SELECT created_at FROM chats WHERE id = $1"),
+    'history_anchor': (('integer', 'integer', 'timestamp'),
+                       "SELECT created_at FROM messages WHERE chat_id = $1 AND id = $2 AND created_at >= $3"),
+    'history_after': (('integer', 'integer', 'timestamp', 'integer'), '''SELECT m.id, m.chat_id, m.sender_id, m.text, m.created_at,
+               u.username, u.name, u.avatar
+               FROM messages m
+               JOIN users u ON m.sender_id = u.id
+               WHERE m.chat_id = $1 AND m.id > $2 AND m.created_at >= $3
+               ORDER BY m.id ASC
+               LIMIT $4'''),
+    'history_after_since': (('integer', 'integer', 'timestamp', 'pg_snapshot', 'timestamp', 'integer'), '''SELECT m.id, m.chat_id, m.sender_id, m.text, m.created_at,
+               u.username, u.name, u.avatar
+               FROM messages m
+               JOIN users u ON m.sender_id = u.id
+               WHERE m.chat_id = $1 AND m.created_at >= $3
+               AND (m.id > $2 OR (m.created_at >= $5 AND NOT pg_visible_in_snapshot(m.changed_xid, $4)))
+               ORDER BY m.id ASC
+               LIMIT $6'''),
+    'history_latest': (('integer', 'timestamp', 'integer'), '''SELECT m.id, m.chat_id, m.sender_id, m.text, m.created_at,
+               u.username, u.name, u.avatar
+               FROM messages m
+               JOIN users u ON m.sender_id = u.id
+               WHERE m.chat_id = $1 AND m.created_at >= $2
+               ORDER BY m.id DESC
+               LIMIT $3'''),
+    'history_before': (('integer', 'integer', 'timestamp', 'integer'), '''SELECT m.id, m.chat_id, m.sender_id, m.text, m.created_at,
+               u.username, u.name, u.avatar
+               FROM messages m
+               JOIN users u ON m.sender_id = u.id
+               WHERE m.chat_id = $1 AND m.id < $2 AND m.created_at >= $3
+               ORDER BY m.id DESC
+               LIMIT $4'''),
+    'read_watermarks': (('integer',), '''SELECT user_id, last_read_message_id FROM chat_members
+        WHERE chat_id = $1
+        ORDER BY last_read_message_id DESC
+        LIMIT 2'''),
+    'insert_message': (('integer', 'integer', 'text'),
+                       "INSERT INTO messages (chat_id, sender_id, text) VALUES ($1, $2, $3) RETURNING id, chat_id, sender_id, text, read, created_at"),
+    'refresh_chat_summary': (('integer', 'integer', 'text', 'timestamp'), f'''UPDATE chats SET last_message_id = $2, last_message_text = $3,
+        last_message_at = $4, updated_at = $4
+        WHERE id = (
+            SELECT id FROM chats
+            WHERE id = $1
+            AND COALESCE(last_message_id, 0) < $2
+            AND COALESCE(last_message_at, '-infinity') < $4 - INTERVAL '{SUMMARY_REFRESH_INTERVAL} seconds'
+            FOR UPDATE SKIP LOCKED
+        )'''),
+    'is_member': (('integer', 'integer'), "SELECT 1 FROM chat_members WHERE chat_id = $1 AND user_id = $2"),
+    'member_chats': (('integer', 'integer[]'), "SELECT chat_id FROM chat_members WHERE user_id = $1 AND chat_id = ANY($2)"),
+    'chat_members': (('integer', 'integer', 'integer'), f'''SELECT u.id, u.profile_version, u.last_seen, {presence_online_sql('u.last_seen')} AS online, cm.is_admin
+        FROM chat_members cm
+        JOIN users u ON u.id = cm.user_id
+        WHERE cm.chat_id = $1 AND cm.user_id > $2
+        ORDER BY cm.user_id
+        LIMIT $3'''),
+    'profiles': (('integer[]',), "SELECT id, username, name, avatar, banner, bio, profile_version FROM users WHERE id = ANY($1)"),
+    'notify': (('text', 'text[]'), "SELECT pg_notify(channel, $1) FROM unnest($2) AS channel"),
+    'mark_read': (('integer', 'integer', 'integer'), f'''UPDATE chat_members cm
+        SET last_read_message_id = LEAST(COALESCE($3, lm.id), lm.id),
+            last_read_at = CASE
+                WHEN $3 IS NULL OR $3 >= lm.id THEN lm.created_at
+                ELSE COALESCE((
+                    SELECT m.created_at FROM messages m
+                    WHERE m.chat_id = c.id AND m.id = $3
+                    AND m.created_at >= COALESCE(cm.last_read_at, c.created_at, '-infinity')
+                        - INTERVAL '{PARTITION_CLOCK_SLACK} seconds'
+                ), cm.last_read_at)
+            END,
+            version = nextval('chat_version_seq')
+        FROM chats c
+        CROSS JOIN LATERAL ({newest_message_sql()}) lm
+        WHERE c.id = cm.chat_id AND cm.chat_id = $1 AND cm.user_id = $2
+        AND cm.last_read_message_id < LEAST(COALESCE($3, lm.id), lm.id)'''),
+}
+PREPARED_STATEMENTS.update(
+    (search_statement_name(filters), search_messages_statement(filters))
+    for size in range(len(SEARCH_FILTERS) + 1)
+    for filters in itertools.combinations([name for name, _, _ in SEARCH_FILTERS], size)
+)
+
+
+def is_chat_member(cur, chat_id: int, user_id: int) -> bool:
+    execute_prepared(cur, 'is_member', (chat_id, user_id))
+    return cur.fetchone() is not None
+
+
+def refresh_chat_summary(cur, chat_id: Any, message: Dict[str, Any]) -> None:
+    # Подсказка обновляется не чаще раза в SUMMARY_REFRESH_INTERVAL, а занятая строка пропускается,
+    # поэтому отправители одного чата не ждут друг друга на блокировке chats
+    execute_prepared(cur, 'refresh_chat_summary', (chat_id, message['id'], message['text'], message['created_at']))
+
+
+def parse_watermark(value: Optional[str]) -> Optional[Tuple[str, datetime]]:
+    # Возвращает снимок и нижнюю границу created_at для сообщений, не видных в нём.
+    # Postgres отвергает неупорядоченные xip ошибкой, а не 400, поэтому снимок проверяется здесь
+    if not value:
+        return None
+    match = WATERMARK_PATTERN.fullmatch(value)
+    if not match:
+        raise ValueError(value)
+    xmin, xmax = int(match.group('xmin')), int(match.group('xmax'))
+    xip = [int(xid) for xid in match.group('xip').split(',')] if match.group('xip') else []
+    if xmin > xmax or xip != sorted(set(xip)) or any(xid < xmin or xid >= xmax for xid in xip):
+        raise ValueError(value)
+    taken_at = datetime(1970, 1, 1) + timedelta(seconds=int(match.group('taken_at')))
+    return match.group('snapshot'), taken_at - timedelta(seconds=PARTITION_CLOCK_SLACK)
+
+
+def take_watermark(cur) -> str:
+    # Снимок берётся до чтения: всё, что в нём видно, попадёт в ответ, а транзакции,
+    # не закоммиченные к снимку, вернутся в следующей дельте. LOCALTIMESTAMP — время начала
+    # транзакции, так что граница по created_at только осторожнее
+    cur.execute("SELECT pg_current_snapshot()::text || '@' || floor(extract(epoch FROM LOCALTIMESTAMP))::bigint AS watermark")
+    return cur.fetchone()['watermark']
+
+
+def fetch_chats(cur, user_id: Any, since: Optional[Tuple[str, datetime]]) -> Tuple[List[Dict[str, Any]], str]:
+    watermark = take_watermark(cur)
+    if since is None:
+        execute_prepared(cur, 'chat_list', (user_id,))
+    else:
+        execute_prepared(cur, 'chat_list_since', (user_id,) + since)
+    chats = [dict(row) for row in cur.fetchall()]
+    return chats, watermark
+
+
+def chat_list_etag(cur, user_id: Any, watermark: Optional[str]) -> str:
+    execute_prepared(cur, 'chat_list_etag', (user_id,))
+    row = cur.fetchone()
+    return (
+        f'W/"chats-{user_id}-{row["version"]}-{row["chats"]}-{row["recent_messages"]}-{row["profiles"]}'
+        f'-{row["presence"]}-{row["presence_now"]}-{watermark or 0}"'
+    )
+
+
+def history_etag(cur, chat_id: Any, before_id: Optional[int], after_id: Optional[int], limit: int,
+                 watermark: Optional[str]) -> str:
+    execute_prepared(cur, 'history_etag', (chat_id,))
+    row = cur.fetchone() or {'version': 0, 'members_version': 0, 'last_message_id': 0, 'recent_messages': 0, 'profiles': 0}
+    return (
+        f'W/"history-{chat_id}-{row["version"]}-{row["members_version"] or 0}-{row["last_message_id"] or 0}'
+        f'-{row["recent_messages"] or 0}-{row["profiles"] or 0}-{before_id or 0}-{after_id or 0}-{limit}-{watermark or 0}"'
+    )
+
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    if_none_match = get_header(event, 'If-None-Match')
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+
+def apply_read_flags(cur, chat_id: Any, messages: List[Dict[str, Any]]) -> None:
+    execute_prepared(cur, 'read_watermarks', (chat_id,))
+    top_readers = cur.fetchall()
+    for message in messages:
+        watermark = next(
+            (row['last_read_message_id'] for row in top_readers if row['user_id'] != message['sender_id']),
+            0
+        )
+        message['read'] = message['id'] <= watermark
+
+
+def highlight_snippet(snippet: str) -> str:
+    # Текст сообщения экранируется целиком, поэтому безопасно вставлять его как HTML: разметкой остаётся только <mark>
+    return html.escape(snippet).replace(SEARCH_HIGHLIGHT_START, '<mark>').replace(SEARCH_HIGHLIGHT_STOP, '</mark>')
+
+
+def search_messages(cur, user_id: int, query: str, chat_id: Optional[int],
+                    cursor: Optional[Tuple[str, int]], limit: int,
+                    date_from: Optional[date] = None, date_to: Optional[date] = None) -> Dict[str, Any]:
+    filter_values = {
+        'chat': (chat_id,) if chat_id is not None else None,
+        'from': (date_from,) if date_from else None,
+        'to': (date_to + timedelta(days=1),) if date_to else None,
+        'cursor': cursor,
+    }
+    filters = tuple(name for name, _, _ in SEARCH_FILTERS if filter_values[name] is not None)
+    params = [SEARCH_CONFIG, query, user_id]
+    for name in filters:
+        params.extend(filter_values[name])
+    execute_prepared(cur, search_statement_name(filters), tuple(params) + (limit + 1, SEARCH_HEADLINE_OPTIONS))
+    rows = [dict(row) for row in cur.fetchall()]
+    has_more = len(rows) > limit
+    results = rows[:limit]
+    
+    next_cursor = None
+    if has_more:
+        next_cursor = f"{results[-1]['rank']}:{results[-1]['id']}"
+    for row in results:
+        row['rank'] = float(row['rank'])
+        row['snippet'] = highlight_snippet(row['snippet'])
+    
+    return {'results': results, 'next_cursor': next_cursor}
+
+
+def upsert_direct_chat(cur, min_user_id: int, max_user_id: int, avatar: str) -> Tuple[int, bool]:
+    cur.execute("SELECT id FROM chats WHERE min_user_id = %s AND max_user_id = %s", (min_user_id, max_user_id))
+    existing = cur.fetchone()
+    if existing:
+        return existing['id'], False
+    
+    # При гонке второй INSERT ждёт первый и после его коммита упирается в уникальный индекс
+    cur.execute(
+        '''INSERT INTO chats (name, avatar, is_group, member_count, min_user_id, max_user_id)
+        VALUES (NULL, %s, FALSE, 2, %s, %s)
+        ON CONFLICT (min_user_id, max_user_id) DO NOTHING
+        RETURNING id''',
+        (avatar, min_user_id, max_user_id)
+    )
+    created = cur.fetchone()
+    if created:
+        return created['id'], True
+    
+    cur.execute("SELECT id FROM chats WHERE min_user_id = %s AND max_user_id = %s", (min_user_id, max_user_id))
+    return cur.fetchone()['id'], False
+
+
+def notify(cur, channels: List[str], payload: Dict[str, Any]) -> None:
+    # Вызывается после коммита изменений, в своей короткой транзакции: при коммите с pg_notify Postgres держит
+    # общую на всю базу блокировку очереди уведомлений до сброса WAL, и отправки во все чаты шли бы по одной.
+    # Транзакция из одного SELECT не пишет WAL, поэтому блокировка снимается сразу
+    execute_prepared(cur, 'notify', (json.dumps(payload), channels))
+    cur.connection.commit()
+
+
+def wait_for_chats(conn, user_id: int, since: Optional[Tuple[str, datetime]], timeout: float) -> Tuple[List[Dict[str, Any]], str]:
+    conn.rollback()
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT chat_id FROM chat_members WHERE user_id = %s", (user_id,))
+        channels = [f'user_{user_id}'] + [f"chat_{row['chat_id']}" for row in cur.fetchall()]
+        cur.execute('; '.join(f'LISTEN {channel}' for channel in channels))
         
-        if method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'send':
-                chat_id = body.get('chat_id')
-                sender_id = body.get('sender_id')
-                text = body.get('text', '').strip()
-                
-                if not chat_id or not sender_id or not text:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'chat_id, sender_id и text обязательны'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute(
-                    "INSERT INTO messages (chat_id, sender_id, text) VALUES (%s, %s, %s) RETURNING id, chat_id, sender_id, text, read, created_at",
-                    (chat_id, sender_id, text)
-                )
-                message = cur.fetchone()
-                
-                cur.execute("UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = %s", (chat_id,))
-                
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'message': dict(message)}),
-                    'isBase64Encoded': False
-                }
+        deadline = time.monotonic() + timeout
+        while True:
+            chats, watermark = fetch_chats(cur, user_id, since)
+            remaining = deadline - time.monotonic()
+            if chats or since is None or remaining <= 0:
+                return chats, watermark
             
-            elif action == 'create_chat':
-                user_ids = body.get('user_ids', [])
-                name = body.get('name')
-                is_group = body.get('is_group', False)
-                
-                if not user_ids or len(user_ids) < 2:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Минимум 2 участника требуется'}),
-                        'isBase64Encoded': False
-                    }
-                
-                if not is_group and len(user_ids) == 2:
-                    cur.execute(
-                        '''SELECT c.id FROM chats c
-                        JOIN chat_members cm1 ON c.id = cm1.chat_id
-                        JOIN chat_members cm2 ON c.id = cm2.chat_id
-                        WHERE c.is_group = FALSE
-                        AND cm1.user_id = %s AND cm2.user_id = %s''',
-                        (user_ids[0], user_ids[1])
-                    )
-                    existing = cur.fetchone()
-                    if existing:
-                        return {
-                            'statusCode': 200,
-                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                            'body': json.dumps({'chat_id': existing['id'], 'exists': True}),
-                            'isBase64Encoded': False
-                        }
-                
-                avatar = f"https://api.dicebear.com/7.x/shapes/svg?seed={name or 'chat'}"
-                
-                cur.execute(
-                    "INSERT INTO chats (name, avatar, is_group) VALUES (%s, %s, %s) RETURNING id",
-                    (name, avatar, is_group)
-                )
-                chat = cur.fetchone()
-                chat_id = chat['id']
-                
-                for idx, user_id in enumerate(user_ids):
-                    is_admin = idx == 0 if is_group else False
-                    cur.execute(
-                        "INSERT INTO chat_members (chat_id, user_id, is_admin) VALUES (%s, %s, %s)",
-                        (chat_id, user_id, is_admin)
-                    )
-                
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'chat_id': chat_id}),
-                    'isBase64Encoded': False
-                }
+            ready, _, _ = select.select([conn], [], [], remaining)
+            if ready:
+                conn.poll()
+                conn.notifies.clear()
+    finally:
+        cur.execute("UNLISTEN *")
+        cur.close()
+        conn.autocommit = False
+
+
+@route('POST', 'send', auth=True)
+def send_message(req: Request) -> Dict[str, Any]:
+    sender_id = req.body.get('sender_id')
+    text = req.body.get('text', '').strip()
+    try:
+        chat_id = int(req.body.get('chat_id') or 0)
+    except (TypeError, ValueError):
+        chat_id = 0
+    
+    if not chat_id or not sender_id or not text:
+        return error_response(400, 'chat_id, sender_id и text обязательны')
+    
+    if not is_chat_member(req.cur, chat_id, req.user_id):
+        return error_response(403, 'Нет доступа к чату')
+    
+    execute_prepared(req.cur, 'insert_message', (chat_id, sender_id, text))
+    message = req.cur.fetchone()
+    
+    refresh_chat_summary(req.cur, chat_id, message)
+    req.conn.commit()
+    notify(req.cur, [f'chat_{chat_id}'], {'type': 'message', 'chat_id': chat_id, 'message_id': message['id']})
+    maintain_message_partitions()
+    
+    return respond(200, {'message': dict(message)})
+
+
+@route('POST', 'send_batch', auth=True)
+def send_message_batch(req: Request) -> Dict[str, Any]:
+    sender_id = req.body.get('sender_id')
+    items = req.body.get('messages') or []
+    
+    if not sender_id or not items or len(items) > SEND_BATCH_MAX_SIZE:
+        return error_response(400, f'sender_id и от 1 до {SEND_BATCH_MAX_SIZE} сообщений обязательны')
+    
+    try:
+        rows = [(int(item.get('chat_id') or 0), sender_id, (item.get('text') or '').strip()) for item in items]
+    except (AttributeError, TypeError, ValueError):
+        rows = [(0, sender_id, '')]
+    if any(not chat_id or not text for chat_id, _, text in rows):
+        return error_response(400, 'У каждого сообщения должны быть chat_id и text')
+    
+    chat_ids = sorted({chat_id for chat_id, _, _ in rows})
+    execute_prepared(req.cur, 'member_chats', (req.user_id, chat_ids))
+    if len(req.cur.fetchall()) != len(chat_ids):
+        return error_response(403, 'Нет доступа к чату')
+    
+    messages = execute_values(
+        req.cur,
+        "INSERT INTO messages (chat_id, sender_id, text) VALUES %s RETURNING id, chat_id, sender_id, text, read, created_at",
+        rows,
+        page_size=len(rows),
+        fetch=True
+    )
+    messages = sorted((dict(message) for message in messages), key=lambda message: message['id'])
+    
+    latest = {message['chat_id']: message for message in messages}
+    for chat_id, message in latest.items():
+        refresh_chat_summary(req.cur, chat_id, message)
+    req.conn.commit()
+    notify(req.cur, [f'chat_{chat_id}' for chat_id in latest], {'type': 'message', 'sender_id': sender_id})
+    maintain_message_partitions()
+    
+    return respond(200, {'messages': messages})
+
+
+@route('POST', 'create_chat', auth=True)
+def create_chat(req: Request) -> Dict[str, Any]:
+    cur = req.cur
+    user_ids = req.body.get('user_ids', [])
+    name = req.body.get('name')
+    is_group = req.body.get('is_group', False)
+    
+    if not user_ids or len(user_ids) < 2:
+        return error_response(400, 'Минимум 2 участника требуется')
+    
+    if str(req.user_id) not in map(str, user_ids):
+        return error_response(403, 'Создатель чата должен быть среди участников')
+    
+    avatar = f"https://api.dicebear.com/7.x/shapes/svg?seed={name or 'chat'}"
+    
+    if not is_group and len(user_ids) != 2:
+        return error_response(400, 'Личный чат требует двух разных участников')
+    
+    if not is_group:
+        try:
+            pair = sorted({int(user_id) for user_id in user_ids})
+        except (TypeError, ValueError):
+            pair = []
+        if len(pair) != 2:
+            return error_response(400, 'Личный чат требует двух разных участников')
         
-        elif method == 'GET':
-            params = event.get('queryStringParameters', {}) or {}
-            user_id = params.get('user_id')
-            chat_id = params.get('chat_id')
-            
-            if chat_id:
-                cur.execute(
-                    '''SELECT m.id, m.chat_id, m.sender_id, m.text, m.read, m.created_at,
-                       u.username, u.name, u.avatar
-                       FROM messages m
-                       JOIN users u ON m.sender_id = u.id
-                       WHERE m.chat_id = %s
-                       ORDER BY m.created_at ASC''',
-                    (chat_id,)
-                )
-                messages = [dict(row) for row in cur.fetchall()]
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'messages': messages}),
-                    'isBase64Encoded': False
-                }
-            
-            elif user_id:
-                cur.execute(
-                    '''SELECT DISTINCT c.id, c.name, c.avatar, c.is_group, c.updated_at,
-                       (SELECT COUNT(*) FROM chat_members WHERE chat_id = c.id) as member_count,
-                       (SELECT text FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
-                       (SELECT created_at FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_time,
-                       COALESCE(cs.pinned, FALSE) as pinned,
-                       (SELECT COUNT(*) FROM messages m WHERE m.chat_id = c.id AND m.sender_id != %s AND m.read = FALSE) as unread_count
-                       FROM chats c
-                       JOIN chat_members cm ON c.id = cm.chat_id
-                       LEFT JOIN chat_settings cs ON c.id = cs.chat_id AND cs.user_id = %s
-                       WHERE cm.user_id = %s
-                       ORDER BY COALESCE(last_message_time, c.created_at) DESC''',
-                    (user_id, user_id, user_id)
-                )
-                chats = [dict(row) for row in cur.fetchall()]
-                
-                for chat in chats:
-                    if not chat['is_group']:
-                        cur.execute(
-                            '''SELECT u.id, u.username, u.name, u.avatar, u.online
-                            FROM users u
-                            JOIN chat_members cm ON u.id = cm.user_id
-                            WHERE cm.chat_id = %s AND u.id != %s
-                            LIMIT 1''',
-                            (chat['id'], user_id)
-                        )
-                        other_user = cur.fetchone()
-                        if other_user:
-                            chat['name'] = other_user['name']
-                            chat['avatar'] = other_user['avatar']
-                            chat['online'] = other_user['online']
-                            chat['other_user_id'] = other_user['id']
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'chats': chats}),
-                    'isBase64Encoded': False
-                }
-            
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'user_id или chat_id обязателен'}),
-                'isBase64Encoded': False
-            }
+        chat_id, created = upsert_direct_chat(cur, pair[0], pair[1], avatar)
+        if not created:
+            req.conn.commit()
+            return respond(200, {'chat_id': chat_id, 'exists': True})
+        user_ids = pair
+    else:
+        cur.execute(
+            "INSERT INTO chats (name, avatar, is_group, member_count) VALUES (%s, %s, %s, %s) RETURNING id",
+            (name, avatar, is_group, len(user_ids))
+        )
+        chat_id = cur.fetchone()['id']
+    
+    execute_values(
+        cur,
+        "INSERT INTO chat_members (chat_id, user_id, is_admin) VALUES %s",
+        [(chat_id, user_id, is_group and idx == 0) for idx, user_id in enumerate(user_ids)],
+        page_size=len(user_ids)
+    )
+    
+    req.conn.commit()
+    notify(cur, [f'user_{user_id}' for user_id in user_ids], {'type': 'chat', 'chat_id': chat_id})
+    
+    return respond(200, {'chat_id': chat_id})
+
+
+@route('GET', 'search', auth=True)
+def search(req: Request) -> Dict[str, Any]:
+    params = req.params
+    query = (params.get('q') or '').strip()
+    try:
+        limit = parse_limit(params.get('limit'), SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+        search_chat_id = int(params['chat_id']) if params.get('chat_id') else None
+        cursor = None
+        if params.get('cursor'):
+            cursor_rank, cursor_id = params['cursor'].split(':')
+            cursor = (str(Decimal(cursor_rank)), int(cursor_id))
+        date_from = date.fromisoformat(params['from']) if params.get('from') else None
+        date_to = date.fromisoformat(params['to']) if params.get('to') else None
+    except (ValueError, ArithmeticError):
+        return error_response(400, 'Некорректные chat_id, limit, cursor, from или to')
+    
+    if not query:
+        return error_response(400, 'q обязателен')
+    
+    return respond(200, search_messages(req.cur, req.user_id, query, search_chat_id, cursor, limit, date_from, date_to))
+
+
+@route('GET', 'wait', auth=True)
+def wait(req: Request) -> Dict[str, Any]:
+    params = req.params
+    try:
+        user_id = int(params.get('user_id'))
+        since = parse_watermark(params.get('since'))
+        timeout = min(float(params.get('timeout') or WAIT_DEFAULT_TIMEOUT), WAIT_MAX_TIMEOUT)
+    except (TypeError, ValueError):
+        return error_response(400, 'user_id обязателен, since должен быть водяным знаком из ответа, timeout — числом')
+    
+    chats, watermark = wait_for_chats(req.conn, user_id, since, max(timeout, 0))
+    
+    return respond(200, {'chats': chats, 'watermark': watermark, 'delta': since is not None})
+
+
+@route('GET', 'history', auth=True)
+def history(req: Request) -> Dict[str, Any]:
+    params = req.params
+    try:
+        chat_id = int(params.get('chat_id'))
+        limit = parse_limit(params.get('limit'))
+        before_id = int(params['before_id']) if params.get('before_id') else None
+        after_id = int(params['after_id']) if params.get('after_id') else None
+    except (TypeError, ValueError):
+        return error_response(400, 'chat_id, before_id, after_id и limit должны быть числами')
+    try:
+        since = parse_watermark(params.get('since'))
+    except ValueError:
+        return error_response(400, 'since должен быть водяным знаком из ответа')
+    
+    if before_id is not None and after_id is not None:
+        return error_response(400, 'Укажите только before_id или after_id')
+    if since is not None and after_id is None:
+        return error_response(400, 'since передаётся вместе с after_id')
+    
+    if not is_chat_member(req.cur, chat_id, req.user_id):
+        return error_response(403, 'Нет доступа к чату')
+    
+    etag = history_etag(req.cur, chat_id, before_id, after_id, limit, params.get('since'))
+    cache_headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+    if etag_matches(req.event, etag):
+        return respond(304, headers=cache_headers)
+    
+    # id выдаётся до коммита, поэтому курсор after_id пропустил бы сообщение с меньшим id,
+    # закоммиченное позже; клиент передаёт этот водяной знак в since вместе со следующим after_id
+    watermark = take_watermark(req.cur)
+    rows = fetch_history(req.cur, chat_id, before_id, after_id, limit, since)
+    has_more = len(rows) > limit
+    if after_id is not None:
+        messages = rows[:limit]
+        next_cursor = messages[-1]['id'] if has_more else None
+    else:
+        messages = rows[:limit][::-1]
+        next_cursor = messages[0]['id'] if has_more else None
+    
+    if messages:
+        apply_read_flags(req.cur, chat_id, messages)
+    
+    return respond(200, {'messages': messages, 'next_cursor': next_cursor, 'has_more': has_more, 'watermark': watermark},
+                   cache_headers)
+
+
+@route('GET', 'chats', auth=True)
+def chat_list(req: Request) -> Dict[str, Any]:
+    user_id = req.params.get('user_id')
+    try:
+        since = parse_watermark(req.params.get('since'))
+    except ValueError:
+        return error_response(400, 'since должен быть водяным знаком из ответа')
+    
+    etag = chat_list_etag(req.cur, user_id, req.params.get('since'))
+    cache_headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+    if etag_matches(req.event, etag):
+        return respond(304, headers=cache_headers)
+    
+    chats, watermark = fetch_chats(req.cur, user_id, since)
+    
+    return respond(200, {'chats': chats, 'watermark': watermark, 'delta': since is not None}, cache_headers)
+
+
+@route('GET', 'members', auth=True)
+def chat_members(req: Request) -> Dict[str, Any]:
+    params = req.params
+    try:
+        chat_id = int(params.get('chat_id'))
+        limit = parse_limit(params.get('limit'), MEMBERS_PAGE_SIZE, MEMBERS_MAX_PAGE_SIZE)
+        cursor = int(params['cursor']) if params.get('cursor') else 0
+    except (TypeError, ValueError):
+        return error_response(400, 'chat_id обязателен, limit и cursor должны быть числами')
+    
+    try:
+        fields = parse_profile_fields(params.get('fields'))
+    except ValueError as e:
+        return error_response(400, f'Неизвестные поля: {e}')
+    
+    if not is_chat_member(req.cur, chat_id, req.user_id):
+        return error_response(403, 'Нет доступа к чату')
+    
+    # Страница идёт по уникальному индексу (chat_id, user_id), курсор — последний отданный user_id
+    execute_prepared(req.cur, 'chat_members', (chat_id, cursor, limit + 1))
+    rows = [dict(row) for row in req.cur.fetchall()]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    return respond(200, {
+        'members': load_profiles(req.cur, rows, fields, ('is_admin',)),
+        'next_cursor': rows[-1]['id'] if has_more else None,
+        'has_more': has_more
+    })
+
+
+@route('GET', '', auth=True)
+def missing_target(req: Request) -> Dict[str, Any]:
+    return error_response(400, 'user_id или chat_id обязателен')
+
+
+@route('PUT', 'mark_read', auth=True)
+def mark_read(req: Request) -> Dict[str, Any]:
+    chat_id = req.body.get('chat_id')
+    user_id = req.body.get('user_id')
+    message_id = req.body.get('message_id')
+    
+    if not chat_id or not user_id:
+        return error_response(400, 'chat_id и user_id обязательны')
+    
+    execute_prepared(req.cur, 'mark_read', (chat_id, user_id, message_id))
+    req.conn.commit()
+    notify(req.cur, [f'user_{user_id}'], {'type': 'read', 'chat_id': chat_id})
+    
+    return respond(200, {'success': True})
+
+
+@route('PUT', 'pin_chat', auth=True)
+def pin_chat(req: Request) -> Dict[str, Any]:
+    chat_id = req.body.get('chat_id')
+    user_id = req.body.get('user_id')
+    pinned = req.body.get('pinned', True)
+    
+    if not chat_id or not user_id:
+        return error_response(400, 'chat_id и user_id обязательны')
+    
+    req.cur.execute(
+        '''INSERT INTO chat_settings (chat_id, user_id, pinned)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET pinned = %s''',
+        (chat_id, user_id, pinned, pinned)
+    )
+    req.cur.execute(
+        "UPDATE chat_members SET version = nextval('chat_version_seq') WHERE chat_id = %s AND user_id = %s",
+        (chat_id, user_id)
+    )
+    req.conn.commit()
+    
+    return respond(200, {'success': True})
+
+
+def authorize(req: Request) -> Optional[Dict[str, Any]]:
+    if req.method == 'GET':
+        claimed_ids = [req.params.get('user_id')]
+    else:
+        claimed_ids = [req.body.get('sender_id'), req.body.get('user_id')]
+    if acts_for_other_user(claimed_ids, req.user_id):
+        return error_response(403, 'Нельзя действовать от имени другого пользователя')
+    return None
+
+
+# >>> shared: handler
+def handle_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return respond(200, headers={
+            'Access-Control-Allow-Methods': ALLOWED_METHODS,
+            'Access-Control-Allow-Headers': ALLOWED_HEADERS,
+            'Access-Control-Max-Age': '86400'
+        })
+    
+    conn = None
+    try:
+        action_route = ROUTES.get((method, request_action(event)))
+        if action_route is None:
+            return error_response(405, 'Method not allowed')
+        action_handler, requires_auth = action_route
         
-        elif method == 'PUT':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'mark_read':
-                chat_id = body.get('chat_id')
-                user_id = body.get('user_id')
-                
-                if not chat_id or not user_id:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'chat_id и user_id обязательны'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute(
-                    "UPDATE messages SET read = TRUE WHERE chat_id = %s AND sender_id != %s AND read = FALSE",
-                    (chat_id, user_id)
-                )
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'pin_chat':
-                chat_id = body.get('chat_id')
-                user_id = body.get('user_id')
-                pinned = body.get('pinned', True)
-                
-                if not chat_id or not user_id:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'chat_id и user_id обязательны'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute(
-                    '''INSERT INTO chat_settings (chat_id, user_id, pinned)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (chat_id, user_id) DO UPDATE SET pinned = %s''',
-                    (chat_id, user_id, pinned, pinned)
-                )
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
+        claims = None
+        if requires_auth:
+            claims = verify_token(get_header(event, 'X-User-Token'))
+            if claims is None:
+                return error_response(401, 'Требуется авторизация')
         
-        cur.close()
-        conn.close()
+        conn = get_db_connection()
+        req = Request(event, conn, claims['uid'] if claims else None)
+        req.claims = claims
+        
+        if claims is not None and is_token_revoked(req.cur, claims['jti']):
+            return error_response(401, 'Сессия завершена')
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        # Проверки, свои для каждой функции, задаются в её authorize()
+        denied = authorize(req)
+        if denied is not None:
+            return denied
+        
+        return action_handler(req)
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        log_event('error', logging.ERROR, error=repr(e), traceback=traceback.format_exc())
+        return error_response(500, str(e))
+    
+    finally:
+        if conn is not None:
+            release_db_connection(conn)
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    _request_metrics.value = metrics = RequestMetrics()
+    response = handle_request(event, context)
+    
+    headers = response.setdefault('headers', {})
+    headers['Server-Timing'] = metrics.server_timing()
+    headers['Access-Control-Expose-Headers'] = 'Server-Timing, ETag'
+    if LOG_REQUESTS:
+        log_event(
+            'request',
+            method=event.get('httpMethod', 'GET'),
+            action=request_action(event),
+            status=response.get('statusCode'),
+            duration_ms=round(metrics.total(), 2),
+            queries=metrics.queries,
+            connect_ms=round(metrics.phases['connect'], 2),
+            query_ms=round(metrics.phases['query'], 2),
+            serialize_ms=round(metrics.phases['serialize'], 2)
+        )
+    _request_metrics.value = None
+    return response
+# <<< shared: handler
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
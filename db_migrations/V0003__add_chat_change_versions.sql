@@ -0,0 +1,6 @@
+CREATE SEQUENCE IF NOT EXISTS chat_version_seq;
+
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('chat_version_seq');
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('chat_version_seq');
+
+CREATE INDEX IF NOT EXISTS idx_chat_members_user_id_version ON chat_members(user_id, version);
@@ -0,0 +1,44 @@
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_id INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_text TEXT;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS member_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_chats_updated_at ON chats(updated_at);
+
+-- Пересборка сводок: SELECT rebuild_chat_summaries(); для всех чатов
+-- или SELECT rebuild_chat_summaries(<chat_id>); для одного
+CREATE OR REPLACE FUNCTION rebuild_chat_summaries(p_chat_id INTEGER DEFAULT NULL) RETURNS INTEGER AS $$
+DECLARE
+    rebuilt INTEGER;
+BEGIN
+    UPDATE chats c SET
+        last_message_id = lm.id,
+        last_message_text = lm.text,
+        last_message_at = lm.created_at,
+        updated_at = COALESCE(lm.created_at, c.created_at),
+        member_count = (SELECT COUNT(*) FROM chat_members WHERE chat_id = c.id),
+        version = nextval('chat_version_seq')
+    FROM chats c2
+    LEFT JOIN LATERAL (
+        SELECT id, text, created_at FROM messages
+        WHERE chat_id = c2.id
+        ORDER BY id DESC
+        LIMIT 1
+    ) lm ON TRUE
+    WHERE c.id = c2.id AND (p_chat_id IS NULL OR c.id = p_chat_id);
+    GET DIAGNOSTICS rebuilt = ROW_COUNT;
+
+    UPDATE chat_members cm SET
+        unread_count = (
+            SELECT COUNT(*) FROM messages m
+            WHERE m.chat_id = cm.chat_id AND m.sender_id != cm.user_id AND m.read = FALSE
+        ),
+        version = nextval('chat_version_seq')
+    WHERE p_chat_id IS NULL OR cm.chat_id = p_chat_id;
+
+    RETURN rebuilt;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_chat_summaries();
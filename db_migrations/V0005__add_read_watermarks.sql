@@ -0,0 +1,37 @@
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER NOT NULL DEFAULT 0;
+
+UPDATE chat_members cm SET last_read_message_id = COALESCE(
+    (SELECT MIN(m.id) - 1 FROM messages m
+     WHERE m.chat_id = cm.chat_id AND m.sender_id != cm.user_id AND m.read = FALSE),
+    (SELECT MAX(m.id) FROM messages m WHERE m.chat_id = cm.chat_id),
+    0
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_members_chat_id_last_read ON chat_members(chat_id, last_read_message_id);
+
+ALTER TABLE chat_members DROP COLUMN IF EXISTS unread_count;
+
+CREATE OR REPLACE FUNCTION rebuild_chat_summaries(p_chat_id INTEGER DEFAULT NULL) RETURNS INTEGER AS $$
+DECLARE
+    rebuilt INTEGER;
+BEGIN
+    UPDATE chats c SET
+        last_message_id = lm.id,
+        last_message_text = lm.text,
+        last_message_at = lm.created_at,
+        updated_at = COALESCE(lm.created_at, c.created_at),
+        member_count = (SELECT COUNT(*) FROM chat_members WHERE chat_id = c.id),
+        version = nextval('chat_version_seq')
+    FROM chats c2
+    LEFT JOIN LATERAL (
+        SELECT id, text, created_at FROM messages
+        WHERE chat_id = c2.id
+        ORDER BY id DESC
+        LIMIT 1
+    ) lm ON TRUE
+    WHERE c.id = c2.id AND (p_chat_id IS NULL OR c.id = p_chat_id);
+    GET DIAGNOSTICS rebuilt = ROW_COUNT;
+
+    RETURN rebuilt;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,4 @@
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS text_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('russian', text)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_text_tsv ON messages USING gin (text_tsv);
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_chat_members_chat_id_version ON chat_members(chat_id, version);
@@ -0,0 +1,20 @@
+-- Канонический ключ личного чата: пара (меньший id, больший id) участников
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS min_user_id INTEGER REFERENCES users(id);
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS max_user_id INTEGER REFERENCES users(id);
+ALTER TABLE chats ADD CONSTRAINT chats_direct_pair_check
+    CHECK ((min_user_id IS NULL AND max_user_id IS NULL) OR (NOT is_group AND min_user_id < max_user_id));
+
+-- Ключ получает самый ранний личный чат каждой пары, более поздние дубли остаются без ключа
+UPDATE chats c SET min_user_id = p.min_user_id, max_user_id = p.max_user_id
+FROM (
+    SELECT DISTINCT ON (MIN(cm.user_id), MAX(cm.user_id))
+        cm.chat_id, MIN(cm.user_id) AS min_user_id, MAX(cm.user_id) AS max_user_id
+    FROM chat_members cm
+    JOIN chats ch ON ch.id = cm.chat_id AND ch.is_group = FALSE
+    GROUP BY cm.chat_id
+    HAVING COUNT(DISTINCT cm.user_id) = 2
+    ORDER BY MIN(cm.user_id), MAX(cm.user_id), cm.chat_id
+) p
+WHERE c.id = p.chat_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_chats_direct_pair ON chats(min_user_id, max_user_id);
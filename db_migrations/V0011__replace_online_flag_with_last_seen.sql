@@ -0,0 +1,4 @@
+-- Статус «в сети» вычисляется по last_seen и TTL присутствия, флаг online больше не используется
+UPDATE users SET last_seen = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE last_seen IS NULL;
+ALTER TABLE users ALTER COLUMN last_seen SET NOT NULL;
+ALTER TABLE users DROP COLUMN IF EXISTS online;
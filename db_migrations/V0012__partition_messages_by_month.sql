@@ -0,0 +1,71 @@
+-- Помесячное секционирование messages по created_at.
+-- Старая таблица переименовывается, данные переливаются в секционированную, затем старая удаляется.
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    chat_id INTEGER REFERENCES chats(id),
+    sender_id INTEGER REFERENCES users(id),
+    text TEXT NOT NULL,
+    read BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    text_tsv tsvector GENERATED ALWAYS AS (to_tsvector('russian', text)) STORED,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Страховочная секция: вставка не падает, если секция месяца ещё не создана
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+-- Создание секций messages_pYYYYMM: SELECT ensure_message_partitions(); на 3 месяца вперёд,
+-- SELECT ensure_message_partitions(3, '2024-01-01'); заодно и за прошедшие месяцы
+CREATE OR REPLACE FUNCTION ensure_message_partitions(
+    p_months_ahead INTEGER DEFAULT 3,
+    p_from TIMESTAMP DEFAULT NULL
+) RETURNS INTEGER AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', COALESCE(p_from, LOCALTIMESTAMP));
+    last_month TIMESTAMP := date_trunc('month', LOCALTIMESTAMP) + make_interval(months => p_months_ahead);
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        partition_name := 'messages_p' || to_char(month_start, 'YYYYMM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_start + INTERVAL '1 month'
+            );
+            created := created + 1;
+        END IF;
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_message_partitions(3, (SELECT MIN(created_at) FROM messages_unpartitioned));
+
+INSERT INTO messages (id, chat_id, sender_id, text, read, created_at)
+SELECT id, chat_id, sender_id, text, read, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM messages_unpartitioned;
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+DROP TABLE messages_unpartitioned;
+
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_text_tsv ON messages USING gin (text_tsv);
+
+-- История чата ограничивается снизу датой создания чата, поэтому она не должна быть позже первого сообщения
+UPDATE chats c SET created_at = first.created_at
+FROM (SELECT chat_id, MIN(created_at) AS created_at FROM messages GROUP BY chat_id) first
+WHERE c.id = first.chat_id AND (c.created_at IS NULL OR c.created_at > first.created_at);
+
+-- Время прочитанного сообщения: нижняя граница для подсчёта непрочитанных
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_at TIMESTAMP;
+
+UPDATE chat_members cm SET last_read_at = m.created_at
+FROM messages m
+WHERE m.chat_id = cm.chat_id AND m.id = cm.last_read_message_id;
+
+ANALYZE messages;
@@ -0,0 +1,4 @@
+-- Версия сообщения из общей последовательности: новое сообщение попадает в дельту списка чатов
+-- без обновления строки chats. Старые сообщения остаются с NULL, чтобы не переписывать секции
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS version BIGINT;
+ALTER TABLE messages ALTER COLUMN version SET DEFAULT nextval('chat_version_seq');
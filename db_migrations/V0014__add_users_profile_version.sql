@@ -0,0 +1,2 @@
+-- Версия профиля растёт при каждом изменении, по ней функции сверяют свои кэши профилей
+ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_version INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,26 @@
+-- Номер версии берётся из последовательности до коммита, поэтому транзакции видны не в порядке версий.
+-- Дельта списка чатов сравнивает транзакцию, изменившую строку, со снимком предыдущего чтения.
+-- Старые строки остаются с NULL и считаются видимыми в любом снимке, чтобы не переписывать секции
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS changed_xid xid8;
+ALTER TABLE chats ALTER COLUMN changed_xid SET DEFAULT pg_current_xact_id();
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS changed_xid xid8;
+ALTER TABLE chat_members ALTER COLUMN changed_xid SET DEFAULT pg_current_xact_id();
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS changed_xid xid8;
+ALTER TABLE messages ALTER COLUMN changed_xid SET DEFAULT pg_current_xact_id();
+
+CREATE OR REPLACE FUNCTION set_changed_xid() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.changed_xid := pg_current_xact_id();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS chats_changed_xid ON chats;
+CREATE TRIGGER chats_changed_xid BEFORE UPDATE ON chats
+    FOR EACH ROW WHEN (NEW.version IS DISTINCT FROM OLD.version)
+    EXECUTE FUNCTION set_changed_xid();
+
+DROP TRIGGER IF EXISTS chat_members_changed_xid ON chat_members;
+CREATE TRIGGER chat_members_changed_xid BEFORE UPDATE ON chat_members
+    FOR EACH ROW WHEN (NEW.version IS DISTINCT FROM OLD.version)
+    EXECUTE FUNCTION set_changed_xid();
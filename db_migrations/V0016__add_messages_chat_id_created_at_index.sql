@@ -0,0 +1,2 @@
+-- Дельта списка чатов ищет незакоммиченные к снимку клиента сообщения чата по нижней границе created_at
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_created_at ON messages(chat_id, created_at);
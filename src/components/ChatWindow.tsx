@@ -10,6 +10,8 @@ interface ChatWindowProps {
   chat: Chat;
   messages: Message[];
   currentUserId: string;
+  hasOlderMessages?: boolean;
+  onLoadOlderMessages?: () => void;
   onSendMessage: (text: string) => void;
   onStartCall: () => void;
   onShowProfile: () => void;
@@ -19,18 +21,21 @@ const ChatWindow = ({
   chat,
   messages,
   currentUserId,
+  hasOlderMessages,
+  onLoadOlderMessages,
   onSendMessage,
   onStartCall,
   onShowProfile,
 }: ChatWindowProps) => {
   const [messageText, setMessageText] = useState('');
   const scrollRef = useRef<HTMLDivElement>(null);
+  const lastMessageId = messages[messages.length - 1]?.id;
 
   useEffect(() => {
     if (scrollRef.current) {
       scrollRef.current.scrollTop = scrollRef.current.scrollHeight;
     }
-  }, [messages]);
+  }, [lastMessageId]);
 
   const handleSend = () => {
     if (messageText.trim()) {
@@ -103,6 +108,18 @@ const ChatWindow = ({
 
       <ScrollArea className="flex-1 p-6" ref={scrollRef}>
         <div className="space-y-4">
+          {hasOlderMessages && onLoadOlderMessages && (
+            <div className="flex justify-center">
+              <Button
+                variant="ghost"
+                size="sm"
+                onClick={onLoadOlderMessages}
+                className="text-xs text-muted-foreground hover:bg-accent"
+              >
+                Загрузить более ранние сообщения
+              </Button>
+            </div>
+          )}
           {messages.map((message, index) => {
             const isCurrentUser = message.senderId === currentUserId;
             const showAvatar =
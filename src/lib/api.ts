@@ -1,5 +1,5 @@
-const AUTH_API = 'https://functions.poehali.dev/391d9d85-8922-4f92-8bb0-d87275577c16';
-const MESSAGES_API = 'https://functions.poehali.dev/f536e054-a014-45e0-a28f-ad322dca5c51';
+const AUTH_API = import.meta.env.VITE_AUTH_API || 'https://functions.poehali.dev/391d9d85-8922-4f92-8bb0-d87275577c16';
+const MESSAGES_API = import.meta.env.VITE_MESSAGES_API || 'https://functions.poehali.dev/f536e054-a014-45e0-a28f-ad322dca5c51';
 
 export interface User {
   id: number;
@@ -9,6 +9,7 @@ export interface User {
   banner?: string;
   bio?: string;
   online?: boolean;
+  last_seen?: string;
 }
 
 export interface Message {
@@ -33,10 +34,37 @@ export interface Chat {
   pinned: boolean;
   unread_count: number;
   online?: boolean;
+  last_seen?: string;
   other_user_id?: number;
   member_count?: number;
 }
 
+let authToken: string | null = null;
+let unauthorizedHandler: (() => void) | null = null;
+
+export const setAuthToken = (token: string | null) => {
+  authToken = token;
+};
+
+export const setUnauthorizedHandler = (handler: (() => void) | null) => {
+  unauthorizedHandler = handler;
+};
+
+const authorizedFetch = async (input: string, init: RequestInit = {}) => {
+  const token = authToken;
+  const headers = new Headers(init.headers);
+  if (token && !headers.has('X-User-Token')) {
+    headers.set('X-User-Token', token);
+  }
+
+  const response = await fetch(input, { ...init, headers });
+  if (response.status === 401 && token && token === authToken && unauthorizedHandler) {
+    unauthorizedHandler();
+  }
+
+  return response;
+};
+
 export const register = async (username: string, name: string, password: string) => {
   const response = await fetch(AUTH_API, {
     method: 'POST',
@@ -67,6 +95,75 @@ export const login = async (username: string, password: string) => {
   return response.json();
 };
 
+export const logout = async () => {
+  const response = await authorizedFetch(AUTH_API, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ action: 'logout' }),
+  });
+  
+  if (!response.ok) {
+    throw new Error('Logout failed');
+  }
+  
+  return response.json();
+};
+
+export interface HeartbeatResponse {
+  online: boolean;
+  ttl: number;
+  heartbeat_interval: number;
+}
+
+export const sendHeartbeat = async () => {
+  const response = await authorizedFetch(AUTH_API, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ action: 'heartbeat' }),
+  });
+  
+  if (!response.ok) {
+    throw new Error('Heartbeat failed');
+  }
+  
+  return response.json() as Promise<HeartbeatResponse>;
+};
+
+export interface Presence {
+  user_id: number;
+  online: boolean;
+  last_seen: string;
+}
+
+export const getPresence = async (userIds: number[]) => {
+  const response = await fetch(`${AUTH_API}?action=presence&ids=${userIds.join(',')}`);
+  
+  if (!response.ok) {
+    throw new Error('Failed to load presence');
+  }
+  
+  const data = await response.json();
+  return data.presence as Presence[];
+};
+
+export type ProfileField = 'id' | 'username' | 'name' | 'avatar' | 'banner' | 'bio' | 'last_seen' | 'online';
+
+export const getUsers = async (userIds: number[], fields?: ProfileField[]) => {
+  const params = new URLSearchParams({ action: 'users', ids: userIds.join(',') });
+  if (fields) {
+    params.set('fields', fields.join(','));
+  }
+
+  const response = await fetch(`${AUTH_API}?${params}`);
+  
+  if (!response.ok) {
+    throw new Error('Failed to load users');
+  }
+  
+  const data = await response.json();
+  return data.users as Partial<User>[];
+};
+
 export const searchUsers = async (search: string) => {
   const response = await fetch(`${AUTH_API}?search=${encodeURIComponent(search)}`);
   
@@ -79,7 +176,7 @@ export const searchUsers = async (search: string) => {
 };
 
 export const updateProfile = async (userId: number, token: string, updates: Partial<User>) => {
-  const response = await fetch(AUTH_API, {
+  const response = await authorizedFetch(AUTH_API, {
     method: 'PUT',
     headers: {
       'Content-Type': 'application/json',
@@ -96,30 +193,140 @@ export const updateProfile = async (userId: number, token: string, updates: Part
   return response.json();
 };
 
-export const getChats = async (userId: number) => {
-  const response = await fetch(`${MESSAGES_API}?user_id=${userId}`);
+export interface ChatsResponse {
+  chats: Chat[];
+  // Непрозрачный водяной знак «снимок@время», передаётся обратно в since без разбора
+  watermark: string;
+  delta: boolean;
+}
+
+export const getChats = async (userId: number, since?: string | null) => {
+  const params = new URLSearchParams({ user_id: userId.toString() });
+  if (since) {
+    params.set('since', since);
+  }
+
+  const response = await authorizedFetch(`${MESSAGES_API}?${params}`);
   
   if (!response.ok) {
     throw new Error('Failed to get chats');
   }
   
-  const data = await response.json();
-  return data.chats as Chat[];
+  return (await response.json()) as ChatsResponse;
+};
+
+export const waitForChatUpdates = async (userId: number, since: string | null) => {
+  const params = new URLSearchParams({ action: 'wait', user_id: userId.toString() });
+  if (since !== null) {
+    params.set('since', since);
+  }
+
+  const response = await authorizedFetch(`${MESSAGES_API}?${params}`);
+  
+  if (!response.ok) {
+    throw new Error('Failed to wait for updates');
+  }
+  
+  return (await response.json()) as ChatsResponse;
 };
 
-export const getMessages = async (chatId: number) => {
-  const response = await fetch(`${MESSAGES_API}?chat_id=${chatId}`);
+export interface MessagesPage {
+  messages: Message[];
+  next_cursor: number | null;
+  has_more: boolean;
+  // Передаётся в since вместе со следующим afterId, чтобы не потерять сообщения, закоммиченные не по порядку id
+  watermark: string;
+}
+
+export const getMessages = async (
+  chatId: number,
+  cursor: { beforeId?: number; afterId?: number; since?: string } = {}
+) => {
+  const params = new URLSearchParams({ chat_id: chatId.toString() });
+  if (cursor.beforeId) {
+    params.set('before_id', cursor.beforeId.toString());
+  }
+  if (cursor.afterId !== undefined) {
+    params.set('after_id', cursor.afterId.toString());
+  }
+  if (cursor.since) {
+    params.set('since', cursor.since);
+  }
+
+  const response = await authorizedFetch(`${MESSAGES_API}?${params}`);
   
   if (!response.ok) {
     throw new Error('Failed to get messages');
   }
   
-  const data = await response.json();
-  return data.messages as Message[];
+  return (await response.json()) as MessagesPage;
+};
+
+export interface ChatMember extends Partial<User> {
+  id: number;
+  is_admin: boolean;
+}
+
+export interface ChatMembersPage {
+  members: ChatMember[];
+  next_cursor: number | null;
+  has_more: boolean;
+}
+
+export const getChatMembers = async (
+  chatId: number,
+  cursor?: number | null,
+  fields?: ProfileField[]
+) => {
+  const params = new URLSearchParams({ action: 'members', chat_id: chatId.toString() });
+  if (cursor) {
+    params.set('cursor', cursor.toString());
+  }
+  if (fields) {
+    params.set('fields', fields.join(','));
+  }
+
+  const response = await authorizedFetch(`${MESSAGES_API}?${params}`);
+  
+  if (!response.ok) {
+    throw new Error('Failed to get chat members');
+  }
+  
+  return (await response.json()) as ChatMembersPage;
+};
+
+export interface MessageSearchResult {
+  id: number;
+  chat_id: number;
+  sender_id: number;
+  created_at: string;
+  rank: number;
+  name: string;
+  avatar: string;
+  // Экранированный HTML, совпадения обёрнуты в <mark>
+  snippet: string;
+}
+
+export const searchMessages = async (query: string, chatId?: number, cursor?: string) => {
+  const params = new URLSearchParams({ action: 'search', q: query });
+  if (chatId) {
+    params.set('chat_id', chatId.toString());
+  }
+  if (cursor) {
+    params.set('cursor', cursor);
+  }
+
+  const response = await authorizedFetch(`${MESSAGES_API}?${params}`);
+  
+  if (!response.ok) {
+    throw new Error('Failed to search messages');
+  }
+  
+  return (await response.json()) as { results: MessageSearchResult[]; next_cursor: string | null };
 };
 
 export const sendMessage = async (chatId: number, senderId: number, text: string) => {
-  const response = await fetch(MESSAGES_API, {
+  const response = await authorizedFetch(MESSAGES_API, {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({ action: 'send', chat_id: chatId, sender_id: senderId, text }),
@@ -134,8 +341,27 @@ export const sendMessage = async (chatId: number, senderId: number, text: string
   return data.message as Message;
 };
 
+export const sendMessageBatch = async (
+  senderId: number,
+  messages: { chat_id: number; text: string }[]
+) => {
+  const response = await authorizedFetch(MESSAGES_API, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ action: 'send_batch', sender_id: senderId, messages }),
+  });
+  
+  if (!response.ok) {
+    const error = await response.json();
+    throw new Error(error.error || 'Failed to send messages');
+  }
+  
+  const data = await response.json();
+  return data.messages as Message[];
+};
+
 export const createChat = async (userIds: number[], name?: string, isGroup: boolean = false) => {
-  const response = await fetch(MESSAGES_API, {
+  const response = await authorizedFetch(MESSAGES_API, {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({ action: 'create_chat', user_ids: userIds, name, is_group: isGroup }),
@@ -151,7 +377,7 @@ export const createChat = async (userIds: number[], name?: string, isGroup: bool
 };
 
 export const markMessagesAsRead = async (chatId: number, userId: number) => {
-  const response = await fetch(MESSAGES_API, {
+  const response = await authorizedFetch(MESSAGES_API, {
     method: 'PUT',
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({ action: 'mark_read', chat_id: chatId, user_id: userId }),
@@ -165,7 +391,7 @@ export const markMessagesAsRead = async (chatId: number, userId: number) => {
 };
 
 export const pinChat = async (chatId: number, userId: number, pinned: boolean) => {
-  const response = await fetch(MESSAGES_API, {
+  const response = await authorizedFetch(MESSAGES_API, {
     method: 'PUT',
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({ action: 'pin_chat', chat_id: chatId, user_id: userId, pinned }),
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import AuthScreen from '@/components/AuthScreen';
 import ChatList from '@/components/ChatList';
 import ChatWindow from '@/components/ChatWindow';
@@ -48,6 +48,7 @@ const Index = () => {
   const [users, setUsers] = useState<LocalUser[]>([]);
   const [chats, setChats] = useState<LocalChat[]>([]);
   const [messages, setMessages] = useState<Record<number, LocalMessage[]>>({});
+  const [olderCursors, setOlderCursors] = useState<Record<number, number | null>>({});
   
   const [selectedChatId, setSelectedChatId] = useState<number | null>(null);
   const [showProfile, setShowProfile] = useState(false);
@@ -55,6 +56,14 @@ const Index = () => {
   const [isCallActive, setIsCallActive] = useState(false);
   const [callUser, setCallUser] = useState<LocalUser | null>(null);
   const [searchQuery, setSearchQuery] = useState('');
+  const chatsWatermark = useRef<string | null>(null);
+  const selectedChatRef = useRef<number | null>(null);
+  const newestSyncedIds = useRef<Record<number, number>>({});
+  const messageWatermarks = useRef<Record<number, string>>({});
+  const chatsRef = useRef<LocalChat[]>([]);
+
+  selectedChatRef.current = selectedChatId;
+  chatsRef.current = chats;
 
   useEffect(() => {
     const savedToken = localStorage.getItem('sim_token');
@@ -63,6 +72,7 @@ const Index = () => {
     if (savedToken && savedUser) {
       try {
         const user = JSON.parse(savedUser);
+        api.setAuthToken(savedToken);
         setToken(savedToken);
         setCurrentUser(user);
         setIsAuthenticated(true);
@@ -75,53 +85,182 @@ const Index = () => {
   }, []);
 
   useEffect(() => {
-    if (isAuthenticated && currentUser) {
-      loadChats();
-      const interval = setInterval(loadChats, 5000);
-      return () => clearInterval(interval);
-    }
+    api.setUnauthorizedHandler(() => {
+      resetSession();
+      toast.error('Сессия истекла, войдите снова');
+    });
+    return () => api.setUnauthorizedHandler(null);
+  }, []);
+
+  useEffect(() => {
+    if (!isAuthenticated || !currentUser) return;
+
+    let cancelled = false;
+
+    const listenForUpdates = async () => {
+      await loadChats();
+      while (!cancelled) {
+        try {
+          const data = await api.waitForChatUpdates(currentUser.id, chatsWatermark.current);
+          if (!cancelled) {
+            applyChats(data);
+          }
+        } catch (error) {
+          console.error('Failed to wait for updates:', error);
+          await new Promise((resolve) => setTimeout(resolve, 5000));
+        }
+      }
+    };
+
+    listenForUpdates();
+    return () => {
+      cancelled = true;
+    };
   }, [isAuthenticated, currentUser]);
 
+  useEffect(() => {
+    if (!isAuthenticated || !currentUser) return;
+
+    let cancelled = false;
+    let timer: ReturnType<typeof setTimeout> | undefined;
+
+    const refreshPresence = async () => {
+      let interval = 30;
+      try {
+        interval = (await api.sendHeartbeat()).heartbeat_interval || interval;
+        const userIds = [...new Set(chatsRef.current.filter((chat) => !chat.isGroup && chat.userId).map((chat) => chat.userId))];
+        if (userIds.length > 0) {
+          const presence = new Map((await api.getPresence(userIds)).map((item) => [item.user_id, item.online]));
+          if (!cancelled) {
+            setChats((prev) => prev.map((chat) =>
+              presence.has(chat.userId) && presence.get(chat.userId) !== chat.online
+                ? { ...chat, online: presence.get(chat.userId) as boolean }
+                : chat
+            ));
+          }
+        }
+      } catch (error) {
+        console.error('Failed to refresh presence:', error);
+      }
+      if (!cancelled) {
+        timer = setTimeout(refreshPresence, interval * 1000);
+      }
+    };
+
+    refreshPresence();
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [isAuthenticated, currentUser]);
+
+  const formatChat = (chat: api.Chat): LocalChat => ({
+    id: chat.id,
+    userId: chat.other_user_id || 0,
+    name: chat.name,
+    avatar: chat.avatar,
+    lastMessage: chat.last_message || '',
+    timestamp: chat.last_message_time ? new Date(chat.last_message_time) : new Date(),
+    unread: chat.unread_count,
+    pinned: chat.pinned,
+    online: chat.online || false,
+    isGroup: chat.is_group,
+    memberIds: [],
+  });
+
+  const applyChats = (data: api.ChatsResponse) => {
+    const formattedChats = data.chats.map(formatChat);
+    chatsWatermark.current = data.watermark;
+
+    if (!data.delta) {
+      setChats(formattedChats);
+      return;
+    }
+    if (formattedChats.length === 0) return;
+
+    setChats((prev) => {
+      const changed = new Map(formattedChats.map((chat) => [chat.id, chat]));
+      const untouched = prev.filter((chat) => !changed.has(chat.id));
+      return [...formattedChats, ...untouched];
+    });
+
+    const openChatId = selectedChatRef.current;
+    if (openChatId !== null && formattedChats.some((chat) => chat.id === openChatId)) {
+      loadNewerMessages(openChatId);
+    }
+  };
+
   const loadChats = async () => {
     if (!currentUser) return;
     
     try {
-      const chatsData = await api.getChats(currentUser.id);
-      const formattedChats: LocalChat[] = chatsData.map((chat) => ({
-        id: chat.id,
-        userId: chat.other_user_id || 0,
-        name: chat.name,
-        avatar: chat.avatar,
-        lastMessage: chat.last_message || '',
-        timestamp: chat.last_message_time ? new Date(chat.last_message_time) : new Date(),
-        unread: chat.unread_count,
-        pinned: chat.pinned,
-        online: chat.online || false,
-        isGroup: chat.is_group,
-        memberIds: [],
-      }));
-      setChats(formattedChats);
+      applyChats(await api.getChats(currentUser.id, chatsWatermark.current));
     } catch (error) {
       console.error('Failed to load chats:', error);
     }
   };
 
+  const formatMessage = (msg: api.Message): LocalMessage => ({
+    id: msg.id.toString(),
+    text: msg.text,
+    senderId: msg.sender_id,
+    timestamp: new Date(msg.created_at),
+    read: msg.read,
+  });
+
   const loadMessages = async (chatId: number) => {
     try {
-      const messagesData = await api.getMessages(chatId);
-      const formattedMessages: LocalMessage[] = messagesData.map((msg) => ({
-        id: msg.id.toString(),
-        text: msg.text,
-        senderId: msg.sender_id,
-        timestamp: new Date(msg.created_at),
-        read: msg.read,
-      }));
-      setMessages((prev) => ({ ...prev, [chatId]: formattedMessages }));
+      const page = await api.getMessages(chatId);
+      const newest = page.messages[page.messages.length - 1];
+      newestSyncedIds.current[chatId] = newest ? newest.id : 0;
+      messageWatermarks.current[chatId] = page.watermark;
+      setMessages((prev) => ({ ...prev, [chatId]: page.messages.map(formatMessage) }));
+      setOlderCursors((prev) => ({ ...prev, [chatId]: page.next_cursor }));
     } catch (error) {
       console.error('Failed to load messages:', error);
     }
   };
 
+  const loadOlderMessages = async (chatId: number) => {
+    const cursor = olderCursors[chatId];
+    if (!cursor) return;
+
+    try {
+      const page = await api.getMessages(chatId, { beforeId: cursor });
+      setMessages((prev) => ({
+        ...prev,
+        [chatId]: [...page.messages.map(formatMessage), ...(prev[chatId] || [])],
+      }));
+      setOlderCursors((prev) => ({ ...prev, [chatId]: page.next_cursor }));
+    } catch (error) {
+      console.error('Failed to load older messages:', error);
+    }
+  };
+
+  const loadNewerMessages = async (chatId: number) => {
+    const afterId = newestSyncedIds.current[chatId];
+    if (afterId === undefined) return;
+
+    try {
+      const page = await api.getMessages(chatId, { afterId, since: messageWatermarks.current[chatId] });
+      messageWatermarks.current[chatId] = page.watermark;
+      if (page.messages.length === 0) return;
+
+      // Сообщение с меньшим id могло закоммититься позже: оно приходит по since и встаёт на своё место
+      newestSyncedIds.current[chatId] = Math.max(afterId, ...page.messages.map((msg) => msg.id));
+      setMessages((prev) => {
+        const existing = prev[chatId] || [];
+        const knownIds = new Set(existing.map((msg) => msg.id));
+        const fresh = page.messages.map(formatMessage).filter((msg) => !knownIds.has(msg.id));
+        if (fresh.length === 0) return prev;
+        const merged = [...existing, ...fresh].sort((a, b) => Number(a.id) - Number(b.id));
+        return { ...prev, [chatId]: merged };
+      });
+    } catch (error) {
+      console.error('Failed to load new messages:', error);
+    }
+  };
+
   const handleLogin = (user: api.User, authToken: string) => {
     const localUser: LocalUser = {
       id: user.id,
@@ -133,6 +272,7 @@ const Index = () => {
       online: user.online,
     };
 
+    api.setAuthToken(authToken);
     setCurrentUser(localUser);
     setToken(authToken);
     setIsAuthenticated(true);
@@ -141,14 +281,24 @@ const Index = () => {
     localStorage.setItem('sim_user', JSON.stringify(localUser));
   };
 
-  const handleLogout = () => {
+  const resetSession = () => {
+    api.setAuthToken(null);
     setIsAuthenticated(false);
     setCurrentUser(null);
     setToken(null);
     setChats([]);
+    chatsWatermark.current = null;
+    newestSyncedIds.current = {};
+    messageWatermarks.current = {};
     setMessages({});
+    setOlderCursors({});
     localStorage.removeItem('sim_token');
     localStorage.removeItem('sim_user');
+  };
+
+  const handleLogout = () => {
+    api.logout().catch((error) => console.error('Failed to revoke session:', error));
+    resetSession();
     toast.success('Вы вышли из аккаунта');
   };
 
@@ -168,13 +318,7 @@ const Index = () => {
     try {
       const message = await api.sendMessage(selectedChatId, currentUser.id, text);
       
-      const newMessage: LocalMessage = {
-        id: message.id.toString(),
-        text: message.text,
-        senderId: message.sender_id,
-        timestamp: new Date(message.created_at),
-        read: message.read,
-      };
+      const newMessage = formatMessage(message);
 
       setMessages((prev) => ({
         ...prev,
@@ -403,6 +547,8 @@ const Index = () => {
             read: m.read,
           }))}
           currentUserId={currentUser?.id.toString() || '0'}
+          hasOlderMessages={Boolean(olderCursors[selectedChat.id])}
+          onLoadOlderMessages={() => loadOlderMessages(selectedChat.id)}
           onSendMessage={handleSendMessage}
           onStartCall={handleStartCall}
           onShowProfile={() => handleShowProfile(selectedChat.userId)}
@@ -1 +1,6 @@
 /// <reference types="vite/client" />
+
+interface ImportMetaEnv {
+  readonly VITE_AUTH_API?: string;
+  readonly VITE_MESSAGES_API?: string;
+}
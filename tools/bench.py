@@ -0,0 +1,494 @@
+'''
+Нагрузочный стенд для обработчиков auth и messages
+Заполняет локальный Postgres синтетическими данными и гоняет смесь запросов через handler()
+
+    python tools/bench.py seed --reset --users 5000 --chats 500 --members 20 --direct-chats 2000 --messages 200000
+    python tools/bench.py run --duration 30 --concurrency 8 --save baseline
+    python tools/bench.py run --duration 30 --concurrency 8 --compare baseline
+    python tools/bench.py hot-chat --levels 1,2,4,8,16 --duration 10
+'''
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from handlers import load_function, migration_files
+from shared_code import check_shared
+
+BASELINES_DIR = Path(__file__).resolve().parent / 'baselines'
+SEED_PASSWORD = 'password'
+COPY_CHUNK_SIZE = 100_000
+WORDS = (
+    'привет как дела что нового давно не виделись встретимся завтра вечером '
+    'отправил документы посмотри когда будет время созвонимся после обеда '
+    'hello meeting deploy release review coffee weekend project deadline'
+).split()
+
+DEFAULT_MIX = {
+    'chat_list': 30,
+    'history': 25,
+    'send': 20,
+    'mark_read': 10,
+    'search': 10,
+    'login': 4,
+    'register': 1,
+    'heartbeat': 0,
+    'presence': 0,
+}
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def connect(dsn: str):
+    conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    conn.autocommit = True
+    return conn
+
+
+def apply_migrations(conn, reset: bool) -> None:
+    cur = conn.cursor()
+    if reset:
+        cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+    for path in migration_files():
+        print(f'migrate {path.name}')
+        cur.execute(path.read_text())
+
+
+def copy_rows(cur, table: str, columns: Tuple[str, ...], rows) -> int:
+    total = 0
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join('\\N' if value is None else str(value) for value in row))
+        buffer.write('\n')
+        total += 1
+        if total % COPY_CHUNK_SIZE == 0:
+            buffer.seek(0)
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+            buffer = io.StringIO()
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+    return total
+
+
+def random_text(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+
+
+def seed(args) -> None:
+    rng = random.Random(args.seed)
+    conn = connect(args.dsn)
+    apply_migrations(conn, args.reset)
+    cur = conn.cursor()
+
+    cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM users")
+    first_user = cur.fetchone()['id'] + 1
+    user_ids = list(range(first_user, first_user + args.users))
+    password_hash = hashlib.sha256(SEED_PASSWORD.encode()).hexdigest()
+    copy_rows(cur, 'users', ('id', 'username', 'name', 'password_hash', 'avatar'), (
+        (user_id, f'user_{user_id}', f'Пользователь {user_id}', password_hash,
+         f'https://api.dicebear.com/7.x/avataaars/svg?seed=user_{user_id}')
+        for user_id in user_ids
+    ))
+    cur.execute("SELECT setval('users_id_seq', (SELECT MAX(id) FROM users))")
+    print(f'users: {len(user_ids)}')
+
+    started_at = time.time() - args.history_days * 86400
+    chats_created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started_at))
+
+    cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM chats")
+    next_chat = cur.fetchone()['id'] + 1
+    chats: List[Tuple[int, bool, List[int]]] = []
+    for _ in range(args.chats):
+        chats.append((next_chat, True, rng.sample(user_ids, min(args.members, len(user_ids)))))
+        next_chat += 1
+    direct_pairs = set()
+    for _ in range(min(args.direct_chats, len(user_ids) * (len(user_ids) - 1) // 2)):
+        pair = tuple(sorted(rng.sample(user_ids, 2)))
+        while pair in direct_pairs:
+            pair = tuple(sorted(rng.sample(user_ids, 2)))
+        direct_pairs.add(pair)
+        chats.append((next_chat, False, list(pair)))
+        next_chat += 1
+
+    copy_rows(cur, 'chats', ('id', 'name', 'avatar', 'is_group', 'min_user_id', 'max_user_id', 'created_at'), (
+        (chat_id, f'Группа {chat_id}' if is_group else None,
+         f'https://api.dicebear.com/7.x/shapes/svg?seed=chat_{chat_id}', 't' if is_group else 'f',
+         None if is_group else min(members), None if is_group else max(members), chats_created_at)
+        for chat_id, is_group, members in chats
+    ))
+    cur.execute("SELECT setval('chats_id_seq', GREATEST((SELECT MAX(id) FROM chats), 1))")
+    copy_rows(cur, 'chat_members', ('chat_id', 'user_id', 'is_admin'), (
+        (chat_id, user_id, 't' if is_group and idx == 0 else 'f')
+        for chat_id, is_group, members in chats
+        for idx, user_id in enumerate(members)
+    ))
+    print(f'chats: {len(chats)}')
+
+    cur.execute("SELECT ensure_message_partitions(3, %s) AS created", (chats_created_at,))
+    print(f"partitions: {cur.fetchone()['created']} created")
+    step = args.history_days * 86400 / max(args.messages, 1)
+
+    def messages():
+        for idx in range(args.messages):
+            chat_id, _, members = rng.choice(chats)
+            created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started_at + idx * step))
+            yield chat_id, rng.choice(members), random_text(rng), created_at
+
+    if chats:
+        copy_rows(cur, 'messages', ('chat_id', 'sender_id', 'text', 'created_at'), messages())
+    print(f'messages: {args.messages}')
+
+    cur.execute("SELECT rebuild_chat_summaries()")
+    cur.execute(
+        '''UPDATE chat_members cm SET last_read_message_id = COALESCE(c.last_message_id, 0), last_read_at = c.last_message_at
+        FROM chats c
+        WHERE c.id = cm.chat_id AND random() < %s''',
+        (args.read_ratio,)
+    )
+    cur.execute("ANALYZE")
+    conn.close()
+
+
+class Workload:
+    def __init__(self, dsn: str, sessions: int, rng: random.Random):
+        self.rng = rng
+        self.auth = load_function('auth')
+        self.messages = load_function('messages')
+
+        conn = connect(dsn)
+        cur = conn.cursor()
+        cur.execute(
+            '''SELECT u.id, u.username, array_agg(cm.chat_id) AS chat_ids
+            FROM users u
+            JOIN chat_members cm ON cm.user_id = u.id
+            WHERE u.username LIKE 'user\\_%%'
+            GROUP BY u.id
+            ORDER BY random()
+            LIMIT %s''',
+            (sessions,)
+        )
+        candidates = cur.fetchall()
+        conn.close()
+        if not candidates:
+            raise SystemExit('Нет данных: сначала запустите seed')
+
+        self.sessions = []
+        for row in candidates:
+            status, body = self.call(self.auth, 'POST', body={
+                'action': 'login', 'username': row['username'], 'password': SEED_PASSWORD
+            })[:2]
+            if status == 200:
+                self.sessions.append({
+                    'user_id': row['id'],
+                    'username': row['username'],
+                    'token': body['token'],
+                    'chat_ids': row['chat_ids'],
+                })
+        if not self.sessions:
+            raise SystemExit('Не удалось войти ни одним пользователем')
+
+        self.operations: Dict[str, Callable[[Dict[str, Any]], Tuple[int, Any, int]]] = {
+            'chat_list': self.chat_list,
+            'history': self.history,
+            'send': self.send,
+            'mark_read': self.mark_read,
+            'search': self.search,
+            'login': self.login,
+            'register': self.register,
+            'heartbeat': self.heartbeat,
+            'presence': self.presence,
+        }
+
+    def call(self, module, method: str, params: Optional[Dict[str, Any]] = None,
+             body: Optional[Dict[str, Any]] = None, token: Optional[str] = None) -> Tuple[int, Any, int]:
+        event = {
+            'httpMethod': method,
+            'headers': {'X-User-Token': token} if token else {},
+            'queryStringParameters': {key: str(value) for key, value in (params or {}).items()},
+            'body': json.dumps(body) if body is not None else '',
+        }
+        response = module.handler(event, None)
+        payload = json.loads(response['body']) if response.get('body') else None
+        match = SERVER_TIMING_QUERIES.search(response.get('headers', {}).get('Server-Timing', ''))
+        return response['statusCode'], payload, int(match.group(1)) if match else 0
+
+    def chat_list(self, session):
+        return self.call(self.messages, 'GET', {'user_id': session['user_id']}, token=session['token'])
+
+    def history(self, session):
+        chat_id = self.rng.choice(session['chat_ids'])
+        return self.call(self.messages, 'GET', {'chat_id': chat_id}, token=session['token'])
+
+    def send(self, session):
+        return self.call(self.messages, 'POST', body={
+            'action': 'send',
+            'chat_id': self.rng.choice(session['chat_ids']),
+            'sender_id': session['user_id'],
+            'text': random_text(self.rng),
+        }, token=session['token'])
+
+    def mark_read(self, session):
+        return self.call(self.messages, 'PUT', body={
+            'action': 'mark_read',
+            'chat_id': self.rng.choice(session['chat_ids']),
+            'user_id': session['user_id'],
+        }, token=session['token'])
+
+    def search(self, session):
+        prefix = session['username'][:self.rng.randint(3, len(session['username']))]
+        return self.call(self.auth, 'GET', {'search': prefix})
+
+    def login(self, session):
+        return self.call(self.auth, 'POST', body={
+            'action': 'login', 'username': session['username'], 'password': SEED_PASSWORD
+        })
+
+    def register(self, session):
+        username = f'bench_{os.getpid()}_{threading.get_ident()}_{time.perf_counter_ns()}'
+        return self.call(self.auth, 'POST', body={
+            'action': 'register', 'username': username[:50], 'name': 'Bench', 'password': SEED_PASSWORD
+        })
+
+    def heartbeat(self, session):
+        return self.call(self.auth, 'POST', body={'action': 'heartbeat'}, token=session['token'])
+
+    def presence(self, session):
+        user_ids = [other['user_id'] for other in self.rng.sample(self.sessions, min(20, len(self.sessions)))]
+        return self.call(self.auth, 'GET', {'action': 'presence', 'ids': ','.join(map(str, user_ids))})
+
+
+def parse_mix(value: Optional[str]) -> Dict[str, int]:
+    if not value:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in value.split(','):
+        name, weight = part.split('=')
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f'Неизвестная операция: {name}')
+        mix[name] = int(weight)
+    return mix
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples: Dict[str, List[Tuple[float, int, bool]]], elapsed: float) -> Dict[str, Any]:
+    operations = {}
+    for name, items in sorted(samples.items()):
+        latencies = [latency for latency, _, _ in items]
+        operations[name] = {
+            'requests': len(items),
+            'errors': sum(1 for _, _, failed in items if failed),
+            'throughput': len(items) / elapsed,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'queries_per_request': sum(queries for _, queries, _ in items) / max(len(items), 1),
+        }
+    total = sum(len(items) for items in samples.values())
+    return {
+        'elapsed_s': elapsed,
+        'requests': total,
+        'throughput': total / elapsed if elapsed else 0.0,
+        'operations': operations,
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    header = f"{'operation':<12}{'reqs':>8}{'errors':>8}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'queries':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, stats in report['operations'].items():
+        print(
+            f"{name:<12}{stats['requests']:>8}{stats['errors']:>8}{stats['throughput']:>10.1f}"
+            f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+            f"{stats['queries_per_request']:>9.2f}"
+        )
+        previous = (baseline or {}).get('operations', {}).get(name)
+        if previous:
+            deltas = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request'):
+                if previous[key]:
+                    deltas.append(f'{key} {100 * (stats[key] - previous[key]) / previous[key]:+.1f}%')
+            print(f"{'':<12}vs baseline: {', '.join(deltas)}")
+    print(f"total: {report['requests']} requests, {report['throughput']:.1f} req/s over {report['elapsed_s']:.1f}s")
+
+
+def run(args) -> None:
+    os.environ['DATABASE_URL'] = args.dsn
+    os.environ.setdefault('SESSION_SECRET', 'bench-secret')
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.concurrency + 1))
+    os.environ.setdefault('LOG_REQUESTS', '0')
+
+    rng = random.Random(args.seed)
+    workload = Workload(args.dsn, args.sessions, rng)
+    mix = parse_mix(args.mix)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    samples: Dict[str, List[Tuple[float, int, bool]]] = {name: [] for name in names}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def worker(worker_id: int) -> None:
+        local_rng = random.Random(args.seed + worker_id)
+        while time.monotonic() < deadline:
+            name = local_rng.choices(names, weights)[0]
+            session = local_rng.choice(workload.sessions)
+            started = time.perf_counter()
+            try:
+                status, _, queries = workload.operations[name](session)
+                failed = status >= 400
+            except Exception:
+                queries, failed = 0, True
+            latency = (time.perf_counter() - started) * 1000
+            with lock:
+                samples[name].append((latency, queries, failed))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(worker, range(args.concurrency)))
+    report = summarize(samples, time.monotonic() - started)
+    report['config'] = {'concurrency': args.concurrency, 'duration': args.duration, 'mix': mix}
+
+    baseline = None
+    if args.compare:
+        baseline = json.loads((BASELINES_DIR / f'{args.compare}.json').read_text())
+    print_report(report, baseline)
+
+    if args.save:
+        BASELINES_DIR.mkdir(exist_ok=True)
+        (BASELINES_DIR / f'{args.save}.json').write_text(json.dumps(report, indent=2, ensure_ascii=False))
+        print(f'saved {BASELINES_DIR / args.save}.json')
+
+
+def hot_chat(args) -> None:
+    levels = sorted({int(level) for level in args.levels.split(',')})
+    os.environ['DATABASE_URL'] = args.dsn
+    os.environ.setdefault('SESSION_SECRET', 'bench-secret')
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(levels[-1] + 1))
+    os.environ.setdefault('LOG_REQUESTS', '0')
+
+    workload = Workload(args.dsn, 1, random.Random(args.seed))
+    conn = connect(args.dsn)
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT c.id, array_agg(u.username ORDER BY u.id) AS usernames, array_agg(u.id ORDER BY u.id) AS user_ids
+        FROM chats c
+        JOIN chat_members cm ON cm.chat_id = c.id
+        JOIN users u ON u.id = cm.user_id
+        WHERE c.is_group AND u.username LIKE 'user\\_%'
+        GROUP BY c.id
+        ORDER BY COUNT(*) DESC
+        LIMIT 1'''
+    )
+    chat = cur.fetchone()
+    conn.close()
+    if not chat:
+        raise SystemExit('Нет групповых чатов: сначала запустите seed')
+
+    senders = []
+    for user_id, username in list(zip(chat['user_ids'], chat['usernames']))[:levels[-1]]:
+        status, body, _ = workload.call(workload.auth, 'POST', body={
+            'action': 'login', 'username': username, 'password': SEED_PASSWORD
+        })
+        if status == 200:
+            senders.append({'user_id': user_id, 'token': body['token']})
+    if len(senders) < levels[-1]:
+        print(f'в чате {chat["id"]} только {len(senders)} участников, уровни выше будут повторять отправителей')
+
+    print(f"chat {chat['id']}: {len(chat['user_ids'])} members")
+    header = f"{'senders':>8}{'sends':>8}{'errors':>8}{'rps':>10}{'p50':>10}{'p99':>10}{'scaling':>9}"
+    print(header)
+    print('-' * len(header))
+    single = None
+    for level in levels:
+        latencies: List[float] = []
+        errors = 0
+        lock = threading.Lock()
+        deadline = time.monotonic() + args.duration
+
+        def worker(worker_id: int) -> None:
+            nonlocal errors
+            sender = senders[worker_id % len(senders)]
+            local_rng = random.Random(args.seed + worker_id)
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    status, _, _ = workload.call(workload.messages, 'POST', body={
+                        'action': 'send', 'chat_id': chat['id'], 'sender_id': sender['user_id'],
+                        'text': random_text(local_rng),
+                    }, token=sender['token'])
+                    failed = status >= 400
+                except Exception:
+                    failed = True
+                latency = (time.perf_counter() - started) * 1000
+                with lock:
+                    latencies.append(latency)
+                    errors += failed
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=level) as pool:
+            list(pool.map(worker, range(level)))
+        throughput = len(latencies) / (time.monotonic() - started)
+        single = single or throughput
+        print(
+            f"{level:>8}{len(latencies):>8}{errors:>8}{throughput:>10.1f}"
+            f"{percentile(latencies, 50):>10.2f}{percentile(latencies, 99):>10.2f}{throughput / single:>8.2f}x"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL', 'postgresql://postgres@localhost/messenger_bench'))
+    parser.add_argument('--seed', type=int, default=42)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='применить миграции и сгенерировать данные')
+    seed_parser.add_argument('--reset', action='store_true', help='пересоздать схему public перед заполнением')
+    seed_parser.add_argument('--users', type=int, default=1000)
+    seed_parser.add_argument('--chats', type=int, default=100, help='число групповых чатов')
+    seed_parser.add_argument('--members', type=int, default=20, help='участников в групповом чате')
+    seed_parser.add_argument('--direct-chats', type=int, default=500)
+    seed_parser.add_argument('--messages', type=int, default=50_000)
+    seed_parser.add_argument('--history-days', type=int, default=90)
+    seed_parser.add_argument('--read-ratio', type=float, default=0.7)
+    seed_parser.set_defaults(func=seed)
+
+    run_parser = commands.add_parser('run', help='прогнать смесь запросов через handler()')
+    run_parser.add_argument('--duration', type=float, default=30)
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--sessions', type=int, default=200, help='сколько пользователей залогинить заранее')
+    run_parser.add_argument('--mix', help='веса операций, например send=50,history=50')
+    run_parser.add_argument('--save', help='сохранить результат как baseline с этим именем')
+    run_parser.add_argument('--compare', help='сравнить с сохранённым baseline')
+    run_parser.set_defaults(func=run)
+
+    hot_parser = commands.add_parser('hot-chat', help='масштабирование отправки при многих отправителях в одном чате')
+    hot_parser.add_argument('--levels', default='1,2,4,8,16', help='числа одновременных отправителей')
+    hot_parser.add_argument('--duration', type=float, default=10, help='секунд на каждый уровень')
+    hot_parser.set_defaults(func=hot_chat)
+
+    args = parser.parse_args()
+    check_shared()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+'''
+Загрузка обработчиков облачных функций из backend/ для локального запуска
+Каждая функция живёт в своём index.py, поэтому модули грузятся под уникальными именами
+'''
+
+import importlib.util
+import json
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import Dict
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / 'db_migrations'
+
+
+def function_names() -> list:
+    with open(BACKEND_DIR / 'func2url.json') as f:
+        return sorted(json.load(f))
+
+
+def load_function(name: str) -> ModuleType:
+    module_name = f'backend_{name}'
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    
+    spec = importlib.util.spec_from_file_location(module_name, BACKEND_DIR / name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_functions() -> Dict[str, ModuleType]:
+    return {name: load_function(name) for name in function_names()}
+
+
+def migration_files() -> list:
+    return sorted(MIGRATIONS_DIR.glob('V*.sql'), key=lambda path: int(path.name[1:].split('__')[0]))
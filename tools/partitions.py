@@ -0,0 +1,179 @@
+'''
+Обслуживание помесячных секций таблицы messages
+Создаёт секции наперёд, выгружает холодные месяцы в сжатые файлы и возвращает их обратно
+
+    python tools/partitions.py list
+    python tools/partitions.py ensure --months-ahead 3
+    python tools/partitions.py archive --older-than 12 --dir message_archive
+    python tools/partitions.py restore message_archive/messages_p202401.csv.gz
+'''
+
+import argparse
+import gzip
+import os
+import re
+from datetime import date
+from pathlib import Path
+from typing import List, Tuple
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+
+PARTITION_NAME = re.compile(r'^messages_p(\d{4})(\d{2})$')
+ARCHIVE_COLUMNS = ('id', 'chat_id', 'sender_id', 'text', 'read', 'created_at')
+ARCHIVE_SUFFIX = '.csv.gz'
+
+
+def connect(dsn: str):
+    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_month(name: str) -> date:
+    match = PARTITION_NAME.match(name)
+    if not match:
+        raise SystemExit(f'{name}: ожидается имя вида messages_pYYYYMM')
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def monthly_partitions(cur) -> List[Tuple[str, date]]:
+    cur.execute(
+        '''SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass'''
+    )
+    names = [row['relname'] for row in cur.fetchall() if PARTITION_NAME.match(row['relname'])]
+    return sorted((name, partition_month(name)) for name in names)
+
+
+def list_partitions(args) -> None:
+    conn = connect(args.dsn)
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bounds,
+           c.reltuples::bigint AS rows, pg_total_relation_size(c.oid) AS bytes
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+        ORDER BY c.relname'''
+    )
+    for row in cur.fetchall():
+        print(f"{row['relname']:<20} {max(row['rows'], 0):>12} rows {row['bytes'] / 1024 / 1024:>10.1f} MB  {row['bounds']}")
+    conn.close()
+
+
+def ensure(args) -> None:
+    conn = connect(args.dsn)
+    cur = conn.cursor()
+    cur.execute("SELECT ensure_message_partitions(%s) AS created", (args.months_ahead,))
+    print(f"created: {cur.fetchone()['created']}")
+    conn.commit()
+    conn.close()
+
+
+def archive(args) -> None:
+    if args.older_than < 1:
+        raise SystemExit('--older-than должен быть не меньше 1')
+    cutoff = add_months(date.today().replace(day=1), -args.older_than)
+    archive_dir = Path(args.dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+
+    conn = connect(args.dsn)
+    cur = conn.cursor()
+    cold = [name for name, month in monthly_partitions(cur) if add_months(month, 1) <= cutoff]
+    conn.rollback()
+
+    for name in cold:
+        target = archive_dir / f'{name}{ARCHIVE_SUFFIX}'
+        if target.exists():
+            raise SystemExit(f'{target} уже существует')
+        partial = target.with_name(target.name + '.part')
+        table = sql.Identifier(name)
+        try:
+            # SHARE блокирует запись в секцию, пока она выгружается и отсоединяется
+            cur.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(table))
+            cur.execute(sql.SQL("SELECT COUNT(*) AS rows FROM {}").format(table))
+            rows = cur.fetchone()['rows']
+            with gzip.open(partial, 'wb') as out:
+                cur.copy_expert(
+                    sql.SQL("COPY {} ({}) TO STDOUT WITH (FORMAT csv)").format(
+                        table, sql.SQL(', ').join(map(sql.Identifier, ARCHIVE_COLUMNS))
+                    ).as_string(conn),
+                    out
+                )
+            cur.execute(sql.SQL("ALTER TABLE messages DETACH PARTITION {}").format(table))
+            cur.execute(sql.SQL("DROP TABLE {}").format(table))
+            partial.rename(target)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            if target.exists():
+                target.unlink()
+            if partial.exists():
+                partial.unlink()
+            raise
+        print(f'{name}: {rows} rows -> {target}')
+
+    if not cold:
+        print(f'нет секций старше {cutoff:%Y-%m}')
+    conn.close()
+
+
+def restore(args) -> None:
+    path = Path(args.file)
+    if not path.name.endswith(ARCHIVE_SUFFIX):
+        raise SystemExit(f'{path}: ожидается файл {ARCHIVE_SUFFIX}')
+    name = path.name[:-len(ARCHIVE_SUFFIX)]
+    month = partition_month(name)
+
+    conn = connect(args.dsn)
+    cur = conn.cursor()
+    cur.execute(
+        sql.SQL("CREATE TABLE {} PARTITION OF messages FOR VALUES FROM (%s) TO (%s)").format(sql.Identifier(name)),
+        (month, add_months(month, 1))
+    )
+    with gzip.open(path, 'rb') as source:
+        cur.copy_expert(
+            sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+                sql.Identifier(name), sql.SQL(', ').join(map(sql.Identifier, ARCHIVE_COLUMNS))
+            ).as_string(conn),
+            source
+        )
+    cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(name)))
+    conn.commit()
+    conn.close()
+    print(f'{path} -> {name}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL', 'postgresql://postgres@localhost/messenger_bench'))
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = commands.add_parser('list', help='показать секции, их границы и размер')
+    list_parser.set_defaults(func=list_partitions)
+
+    ensure_parser = commands.add_parser('ensure', help='создать секции до текущего месяца плюс запас')
+    ensure_parser.add_argument('--months-ahead', type=int, default=3)
+    ensure_parser.set_defaults(func=ensure)
+
+    archive_parser = commands.add_parser('archive', help='выгрузить и отсоединить холодные секции')
+    archive_parser.add_argument('--older-than', type=int, default=12, help='сколько последних месяцев оставить в базе')
+    archive_parser.add_argument('--dir', default='message_archive')
+    archive_parser.set_defaults(func=archive)
+
+    restore_parser = commands.add_parser('restore', help='вернуть выгруженную секцию в базу')
+    restore_parser.add_argument('file')
+    restore_parser.set_defaults(func=restore)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+'''
+Локальный HTTP-сервер для функций из backend/
+Переводит HTTP-запросы в event облачной функции и выполняет handler() в ограниченном пуле потоков
+
+    python tools/serve.py --port 8000 --concurrency 16
+    curl 'http://localhost:8000/auth?action=presence&ids=1,2'
+    curl -H 'X-User-Token: ...' 'http://localhost:8000/messages?user_id=1'
+'''
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import signal
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from types import ModuleType
+from typing import Any, Dict, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from handlers import function_names, load_function
+from shared_code import check_shared
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 10 * 1024 * 1024
+KEEP_ALIVE_TIMEOUT = 15
+# Долгие опросы держат поток до WAIT_MAX_TIMEOUT секунд, поэтому у них свой пул
+LONG_POLL_ACTIONS = ('wait',)
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def json_response(status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': dict({'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, **(headers or {})),
+        'body': json.dumps(payload, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, Dict[str, str], bytes]]:
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT)
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise HttpError(400, 'Запрос оборван')
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(431, 'Слишком большие заголовки')
+    except asyncio.TimeoutError:
+        return None
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ', 2)
+    except ValueError:
+        raise HttpError(400, 'Некорректная строка запроса')
+
+    headers: Dict[str, str] = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(':')
+        name = name.strip()
+        headers[name] = f'{headers[name]}, {value.strip()}' if name in headers else value.strip()
+
+    lowered = {name.lower(): value for name, value in headers.items()}
+    if 'chunked' in lowered.get('transfer-encoding', '').lower():
+        raise HttpError(501, 'Transfer-Encoding: chunked не поддерживается')
+    try:
+        length = int(lowered.get('content-length') or 0)
+    except ValueError:
+        raise HttpError(400, 'Некорректный Content-Length')
+    if length < 0 or length > MAX_BODY_SIZE:
+        raise HttpError(413, 'Слишком большое тело запроса')
+
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target, version, headers, body
+
+
+def build_event(method: str, target: str, headers: Dict[str, str], body: bytes, peer: str) -> Dict[str, Any]:
+    url = urlsplit(target)
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        raise HttpError(400, 'Тело запроса должно быть в UTF-8')
+    return {
+        'httpMethod': method,
+        'path': url.path,
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(url.query, keep_blank_values=True)),
+        'body': text,
+        'isBase64Encoded': False,
+        'requestContext': {'identity': {'sourceIp': peer}}
+    }
+
+
+def encode_response(response: Dict[str, Any], keep_alive: bool) -> bytes:
+    status = int(response.get('statusCode', 200))
+    body = response.get('body') or ''
+    if response.get('isBase64Encoded'):
+        data = base64.b64decode(body)
+    else:
+        data = body.encode('utf-8') if isinstance(body, str) else json.dumps(body).encode('utf-8')
+    if status in (204, 304):
+        data = b''
+
+    headers = dict(response.get('headers') or {})
+    headers['Content-Length'] = str(len(data))
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    try:
+        phrase = HTTPStatus(status).phrase
+    except ValueError:
+        phrase = ''
+    head = f'HTTP/1.1 {status} {phrase}\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    return head.encode('latin-1', errors='replace') + b'\r\n' + data
+
+
+class LocalServer:
+    def __init__(self, functions: Dict[str, ModuleType], concurrency: int, wait_concurrency: int,
+                 max_pending: int, shutdown_timeout: float) -> None:
+        self.functions = functions
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='handler')
+        self.wait_executor = ThreadPoolExecutor(max_workers=wait_concurrency, thread_name_prefix='wait')
+        self.max_pending = max_pending
+        self.shutdown_timeout = shutdown_timeout
+        self.pending = 0
+        self.waiting = 0
+        self.idle: Optional[asyncio.Event] = None
+        self.stopping = False
+        self.connections: Set[asyncio.StreamWriter] = set()
+        self.busy: Set[asyncio.StreamWriter] = set()
+
+    async def dispatch(self, method: str, target: str, headers: Dict[str, str], body: bytes, peer: str) -> Dict[str, Any]:
+        name = urlsplit(target).path.strip('/').split('/', 1)[0]
+        module = self.functions.get(name)
+        if module is None:
+            return json_response(404, {'error': f"Функция '{name}' не найдена, доступны: {', '.join(sorted(self.functions))}"})
+
+        event = build_event(method, target, headers, body, peer)
+        long_poll = event['queryStringParameters'].get('action') in LONG_POLL_ACTIONS
+        # Очередь к пулу обычных запросов ограничена: лишние сразу получают 503, а не копятся в памяти.
+        # Припаркованные долгие опросы в этот счёт не входят
+        if not long_poll and self.pending >= self.max_pending:
+            return json_response(503, {'error': 'Сервер перегружен'}, {'Retry-After': '1'})
+
+        if long_poll:
+            self.waiting += 1
+        else:
+            self.pending += 1
+        self.idle.clear()
+        try:
+            executor = self.wait_executor if long_poll else self.executor
+            return await asyncio.get_running_loop().run_in_executor(executor, module.handler, event, None)
+        except Exception as e:
+            traceback.print_exc()
+            return json_response(500, {'error': str(e)})
+        finally:
+            if long_poll:
+                self.waiting -= 1
+            else:
+                self.pending -= 1
+            if self.pending == 0 and self.waiting == 0:
+                self.idle.set()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = (writer.get_extra_info('peername') or ('', 0))[0]
+        self.connections.add(writer)
+        try:
+            while not self.stopping:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, target, version, headers, body = request
+                    self.busy.add(writer)
+                    connection = next((value.lower() for name, value in headers.items() if name.lower() == 'connection'), '')
+                    keep_alive = connection != 'close' and (version == 'HTTP/1.1' or connection == 'keep-alive')
+                    response = await self.dispatch(method, target, headers, body, peer)
+                except HttpError as e:
+                    writer.write(encode_response(json_response(e.status, {'error': str(e)}), False))
+                    await writer.drain()
+                    break
+
+                keep_alive = keep_alive and not self.stopping
+                writer.write(encode_response(response, keep_alive))
+                await writer.drain()
+                self.busy.discard(writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.busy.discard(writer)
+            self.connections.discard(writer)
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        self.idle = asyncio.Event()
+        self.idle.set()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_SIZE)
+        for name in sorted(self.functions):
+            print(f'{name}: http://{host}:{port}/{name}')
+
+        await stop.wait()
+        print('остановка: новые соединения не принимаются')
+        self.stopping = True
+        server.close()
+        for writer in list(self.connections - self.busy):
+            writer.close()
+        try:
+            await asyncio.wait_for(self.idle.wait(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            print(f'не дождались {self.pending + self.waiting} запросов за {self.shutdown_timeout:g} с')
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.wait_executor.shutdown(wait=False, cancel_futures=True)
+        for module in self.functions.values():
+            pool = getattr(module, '_db_pool', None)
+            if pool is not None:
+                pool.closeall()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL', 'postgresql://postgres@localhost/messenger_bench'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--functions', help='какие функции поднять, по умолчанию все из func2url.json')
+    parser.add_argument('--concurrency', type=int, default=16, help='потоков для обычных запросов')
+    parser.add_argument('--wait-concurrency', type=int, default=64, help='потоков для долгих опросов action=wait')
+    parser.add_argument('--max-pending', type=int, help='сколько обычных запросов держать в работе и очереди до ответа 503')
+    parser.add_argument('--shutdown-timeout', type=float, default=30, help='сколько ждать незавершённые запросы при остановке')
+    args = parser.parse_args()
+    check_shared()
+
+    if args.concurrency < 1 or args.wait_concurrency < 1:
+        raise SystemExit('--concurrency и --wait-concurrency должны быть не меньше 1')
+
+    # Обработчики читают окружение при импорте, поэтому оно задаётся до load_function
+    os.environ['DATABASE_URL'] = args.dsn
+    os.environ.setdefault('SESSION_SECRET', 'local-secret')
+    # Соединения для обычных запросов открываются сразу, долгие опросы добирают их до максимума
+    os.environ.setdefault('DB_POOL_MIN_SIZE', str(args.concurrency))
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.concurrency + args.wait_concurrency))
+
+    names = args.functions.split(',') if args.functions else function_names()
+    unknown = sorted(set(names) - set(function_names()))
+    if unknown:
+        raise SystemExit(f"Неизвестные функции: {', '.join(unknown)}")
+
+    server = LocalServer(
+        {name: load_function(name) for name in names},
+        args.concurrency,
+        args.wait_concurrency,
+        args.max_pending or args.concurrency * 4,
+        args.shutdown_timeout
+    )
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Общий код функций из backend/
+Каждая функция деплоится из своего каталога, поэтому общие помощники лежат в её index.py
+между маркерами «# >>> shared: <имя>» и «# <<< shared: <имя>». Скрипт проверяет, что копии
+во всех функциях совпадают, и переносит правку из одной функции в остальные
+
+    python tools/shared_code.py check
+    python tools/shared_code.py sync --from messages
+'''
+
+import argparse
+import difflib
+import re
+from typing import Dict, List
+
+from handlers import BACKEND_DIR, function_names
+
+BLOCK = re.compile(r'^# >>> shared: (?P<name>\w+)\n.*?^# <<< shared: (?P=name)\n', re.M | re.S)
+
+
+def index_path(name: str):
+    return BACKEND_DIR / name / 'index.py'
+
+
+def shared_blocks(name: str) -> Dict[str, str]:
+    return {match.group('name'): match.group(0) for match in BLOCK.finditer(index_path(name).read_text())}
+
+
+def mismatches() -> List[str]:
+    names = function_names()
+    blocks = {name: shared_blocks(name) for name in names}
+    reference = names[0]
+    problems = []
+    for name in names[1:]:
+        for block in sorted(set(blocks[reference]) | set(blocks[name])):
+            left = blocks[reference].get(block)
+            right = blocks[name].get(block)
+            if left is None or right is None:
+                missing = reference if left is None else name
+                problems.append(f'{missing}: нет блока shared: {block}')
+            elif left != right:
+                diff = difflib.unified_diff(
+                    left.splitlines(keepends=True), right.splitlines(keepends=True),
+                    f'{reference}/index.py', f'{name}/index.py'
+                )
+                problems.append(f'shared: {block} различается\n' + ''.join(diff))
+    return problems
+
+
+def check_shared() -> None:
+    problems = mismatches()
+    if problems:
+        raise SystemExit('\n'.join(problems) + '\nСинхронизируйте: python tools/shared_code.py sync --from <функция>')
+
+
+def check(args) -> None:
+    check_shared()
+    print(f"общий код совпадает: {', '.join(function_names())}")
+
+
+def sync(args) -> None:
+    source = shared_blocks(args.source)
+    if not source:
+        raise SystemExit(f'{args.source}: блоки shared не найдены')
+    for name in function_names():
+        if name == args.source:
+            continue
+        path = index_path(name)
+        text = path.read_text()
+        found = set()
+
+        def replace(match):
+            found.add(match.group('name'))
+            return source.get(match.group('name'), match.group(0))
+
+        updated = BLOCK.sub(replace, text)
+        missing = sorted(set(source) - found)
+        if missing:
+            raise SystemExit(f"{name}: нет блоков {', '.join(missing)}, добавьте маркеры вручную")
+        if updated != text:
+            path.write_text(updated)
+            print(f'{name}: обновлён')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    check_parser = commands.add_parser('check', help='убедиться, что общий код во всех функциях совпадает')
+    check_parser.set_defaults(func=check)
+
+    sync_parser = commands.add_parser('sync', help='скопировать общий код из одной функции в остальные')
+    sync_parser.add_argument('--from', dest='source', required=True, choices=function_names())
+    sync_parser.set_defaults(func=sync)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()